@@ -0,0 +1,81 @@
+# alertbook.py
+import heapq
+from bisect import bisect_left, insort
+
+class AlertBook:
+    """
+    In-memory index of active alert rows. Thresholds are kept sorted per asset
+    so the alerts triggered by a price are found with a bisect and a slice.
+    """
+
+    def __init__(self, key=lambda name: name):
+        self.key = key
+        self._thresholds = {} # asset -> sorted [(alert_value, alert_id)]
+        self._alerts = {} # alert_id -> row
+        self._requesters = {} # requester_id -> {alert_id}
+        self._expiry = [] # heap of (expires_at, alert_id)
+
+    def load(self, rows):
+        self._thresholds.clear()
+        self._alerts.clear()
+        self._requesters.clear()
+        self._expiry.clear()
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        alert_id = row[0]
+        self.remove(alert_id)
+        self._alerts[alert_id] = row
+        insort(self._thresholds.setdefault(self.key(row[1]), []), (row[4], alert_id))
+        self._requesters.setdefault(row[3], set()).add(alert_id)
+        if row[10]:
+            heapq.heappush(self._expiry, (row[10], alert_id))
+
+    def remove(self, alert_id):
+        row = self._alerts.pop(alert_id, None)
+        if row is None:
+            return None
+        asset = self.key(row[1])
+        thresholds = self._thresholds[asset]
+        del thresholds[bisect_left(thresholds, (row[4], alert_id))]
+        if not thresholds:
+            del self._thresholds[asset]
+        requester_alerts = self._requesters[row[3]]
+        requester_alerts.discard(alert_id)
+        if not requester_alerts:
+            del self._requesters[row[3]]
+        return row
+
+    def requester_alerts(self, requester_id):
+        return [self._alerts[alert_id] for alert_id in sorted(self._requesters.get(requester_id, ()))]
+
+    def remove_requester(self, requester_id):
+        for alert_id in list(self._requesters.get(requester_id, ())):
+            self.remove(alert_id)
+
+    def expire(self, now):
+        """Drops alerts whose expires_at timestamp is at or before now."""
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, alert_id = heapq.heappop(self._expiry)
+            row = self._alerts.get(alert_id)
+            if row is not None and row[10] == expires_at:
+                self.remove(alert_id)
+
+    def assets(self):
+        return list(self._thresholds)
+
+    def thresholds(self, asset):
+        return [value for value, _ in self._thresholds.get(self.key(asset), ())]
+
+    def count(self, asset):
+        return len(self._thresholds.get(self.key(asset), ()))
+
+    def triggered(self, asset, price):
+        """Returns the rows for asset with an alert value at or above price."""
+        thresholds = self._thresholds.get(self.key(asset), [])
+        i = bisect_left(thresholds, (price,))
+        return [self._alerts[alert_id] for _, alert_id in thresholds[i:]]
+
+    def __len__(self):
+        return len(self._alerts)
@@ -0,0 +1,187 @@
+# benchmarks/bench.py
+"""
+Offline microbenchmarks for the hot paths in bot.py.
+
+    python benchmarks/bench.py [--output results.json] [--sizes 1000 10000 100000]
+
+Upstream responses are served from the recorded JSON fixtures in
+benchmarks/fixtures and the alert cycles run against a temporary SQLite
+database, so no network access or Discord connection is needed. Results are
+written as JSON with per-call timings in microseconds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT)
+
+import bot
+import db
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)
+
+def summarise(timings, number):
+    per_call = [t / number * 1e6 for t in timings]
+    return {
+        "number": number,
+        "repeat": len(timings),
+        "min_us": min(per_call),
+        "median_us": statistics.median(per_call),
+        "mean_us": statistics.mean(per_call)
+    }
+
+def measure(func, number, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append(time.perf_counter() - start)
+    return summarise(timings, number)
+
+def measure_async(loop, func, number, repeat=5):
+    async def batch():
+        for _ in range(number):
+            await func()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        loop.run_until_complete(batch())
+        timings.append(time.perf_counter() - start)
+    return summarise(timings, number)
+
+def prime_caches():
+    """Seeds the FX table and ETH price cache so the collect_* functions stay offline."""
+    bot.COIN_CACHE.ttl = float('inf')
+    bot.FX_RATES.load({'GBP': 0.77, 'EUR': 0.92}, time.time())
+    bot.COIN_CACHE.set(('eth', True), {"USD": 3080.12})
+
+def bench_functions(loop):
+    symbol_data = bot.fetch_from_dict_symbol(load_fixture('cmc_quotes_symbol.json'), 'BTC')
+    nft_raw = load_fixture('opensea_collection.json')
+    metrics_raw = load_fixture('cmc_global_metrics.json')
+
+    crypto_details = bot.collect_data(symbol_data)
+    nft_details = loop.run_until_complete(bot.collect_nft_data(nft_raw))
+    metric_details = bot.collect_metric_data(metrics_raw)
+    colour = bot.get_colour('BTC')
+
+    names = [f"asset{i}" for i in range(10000)]
+    counter = iter(range(10**9))
+
+    return {
+        "safeget": measure(lambda: bot.safeget(symbol_data, 'quote', 'USD', 'price'), 100000),
+        "safeget_miss": measure(lambda: bot.safeget(symbol_data, 'quote', 'GBP', 'price'), 100000),
+        "round_to_n": measure(lambda: bot.round_to_n(789624536915.89, 6), 100000),
+        "get_colour": measure(lambda: bot.get_colour('BTC'), 100000),
+        "get_colour_uncached": measure(lambda: bot.get_colour.__wrapped__(names[next(counter) % len(names)]), 100000),
+        "collect_data": measure(lambda: bot.collect_data(symbol_data), 10000),
+        "collect_nft_data": measure_async(loop, lambda: bot.collect_nft_data(nft_raw), 10000),
+        "collect_metric_data": measure(lambda: bot.collect_metric_data(metrics_raw), 10000),
+        "generate_crypto_message": measure(lambda: bot.generate_crypto_message(crypto_details, colour), 10000),
+        "generate_crypto_message_uncached": measure(lambda: bot.generate_crypto_message.__wrapped__(crypto_details, colour), 2000),
+        "generate_nft_message": measure(lambda: bot.generate_nft_message(nft_details, colour), 10000),
+        "generate_nft_message_uncached": measure(lambda: bot.generate_nft_message.__wrapped__(nft_details, colour), 2000),
+        "generate_metrics_message": measure(lambda: bot.generate_metrics_message(metric_details, 0xFFD700), 10000),
+        "generate_metrics_message_uncached": measure(lambda: bot.generate_metrics_message.__wrapped__(metric_details, 0xFFD700), 2000)
+    }
+
+def seed_alerts(type, size, assets, rng):
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            f"INSERT INTO {db.get_table(type)} "
+            "(name, requester, requester_id, alert_value, triggered, time_added, expires_at, active, channel_id)"
+            "VALUES (?, ?, ?, ?, 0, CURRENT_TIMESTAMP, datetime(CURRENT_TIMESTAMP, '+30 days'), 'Y', ?)",
+            [
+                (rng.choice(assets), f"user{i % 5000}", str(i % 5000), rng.uniform(0, 100), i % 200)
+                for i in range(size)
+            ]
+        )
+
+def bench_alert_cycles(loop, sizes):
+    """
+    Times loading the alert books and evaluating one nft_alert/coin_alert
+    cycle. Every asset is priced at 50 so roughly half the alerts fire;
+    sending is replaced with a counter so the books are unchanged between
+    repeats.
+    """
+    fired = []
+
+    async def record_alert(channel_id, requester_id, item, value, alert_value, alert_id):
+        fired.append(alert_id)
+
+    async def nft_floor(slug):
+        return 50.0
+
+    async def coin_prices(symbols):
+        return {symbol.upper(): 50.0 for symbol in symbols}
+
+    bot.send_nft_alert = record_alert
+    bot.send_coin_alert = record_alert
+    bot.get_nft_floor = nft_floor
+    bot.get_coin_prices = coin_prices
+
+    results = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.close()
+            db.DB_PATH = os.path.join(tmp, 'bench.db')
+            rng = random.Random(size)
+            assets = [f"asset{i}" for i in range(max(size // 100, 1))]
+            seed_alerts('nft', size, assets, rng)
+            seed_alerts('coin', size, assets, rng)
+
+            results[f"load_alert_books_{size}"] = measure(bot.load_alert_books, 1, repeat=3)
+
+            for type, book, cycle in (('nft', bot.NFT_ALERTS, bot.nft_alert), ('coin', bot.COIN_ALERTS, bot.coin_alert)):
+                book_assets = book.assets()
+                fired.clear()
+                loop.run_until_complete(cycle(book, book_assets))
+                fired_count = len(fired)
+                result = measure_async(loop, lambda: cycle(book, book_assets), 1, repeat=5)
+                result.update({"alerts": size, "assets": len(book_assets), "fired": fired_count})
+                results[f"{type}_alert_{size}"] = result
+            db.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help="write results to this file instead of stdout")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="synthetic alert counts")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    prime_caches()
+
+    results = bench_functions(loop)
+    results.update(bench_alert_cycles(loop, args.sizes))
+
+    report = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
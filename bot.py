@@ -2,41 +2,259 @@
 import os
 import discord
 from dotenv import load_dotenv
-from requests import Session, get, request
-from requests.exceptions import ConnectionError, Timeout, TooManyRedirects
-import json
+import circuit
+import db
+import http_client
+import instrumentation
+import ratelimit
+from alertbook import AlertBook
+from cache import TTLCache, cached
+from commandqueue import CommandQueue
+from dispatch import AlertDispatcher
+import fx
+from history import PriceHistory, TIERS
+from resolver import ListingsSnapshot, SymbolIndex
+from scheduler import PollScheduler
+import stream
+import supervisor
 import logging
 from math import log10, floor
-import random
-import sqlite3
+import functools
+import hashlib
+import itertools
+from datetime import datetime
 import time
 import asyncio
-
-DB_PATH = "watchlist.db"
+import signal
 
 load_dotenv()
+
+COIN_BATCH_SIZE = 100
+
+COIN_CACHE = TTLCache(maxsize=1024, ttl=60)
+NFT_CACHE = TTLCache(maxsize=1024, ttl=60)
+METRICS_CACHE = TTLCache(maxsize=1, ttl=5 * 60)
+NFT_MISSES = TTLCache(maxsize=4096, ttl=60 * 60)
+RENDER_CACHE = TTLCache(maxsize=512, ttl=10 * 60)
+# last good results, served marked as stale while a provider is failing
+COIN_STALE = TTLCache(maxsize=1024, ttl=24 * 60 * 60)
+NFT_STALE = TTLCache(maxsize=1024, ttl=24 * 60 * 60)
+METRICS_STALE = TTLCache(maxsize=1, ttl=24 * 60 * 60)
+STALE_FOOTER = "Provider unavailable - showing the last known (stale) data"
+
+# stamped on every collected quote so rendered embeds can be reused until the data changes
+SNAPSHOT_VERSIONS = itertools.count()
+
+COIN_INDEX = SymbolIndex()
+COIN_MAP_PAGE_SIZE = 5000
+COIN_MAP_REFRESH = int(os.getenv('COIN_MAP_REFRESH', 24 * 60 * 60))
+
+# top coins by market cap, refreshed in bulk so only the long tail is quoted per coin
+LISTINGS = ListingsSnapshot()
+LISTINGS_LIMIT = int(os.getenv('LISTINGS_LIMIT', 200))
+LISTINGS_PAGE_SIZE = 5000
+LISTINGS_REFRESH = int(os.getenv('LISTINGS_REFRESH', 5 * 60))
+# a snapshot older than this is ignored until a refresh succeeds
+LISTINGS_MAX_AGE = 3 * LISTINGS_REFRESH
+
+# fiat rates against USD, refreshed as one table so quotes are converted without a request
+FX_CURRENCIES = [c.strip().upper() for c in os.getenv('FX_CURRENCIES', 'GBP,EUR').split(',') if c.strip()]
+FX_DEFAULT_CURRENCY = os.getenv('FX_DEFAULT_CURRENCY', 'GBP').upper()
+FX_RATES = fx.RateTable(FX_CURRENCIES + [FX_DEFAULT_CURRENCY])
+FX_REFRESH = int(os.getenv('FX_REFRESH', 60 * 60))
+FX_RETRY = 60
+FX_PAIRS_PER_REQUEST = 2 # currconv free plan limit
+GUILD_CURRENCIES = {}
+
+HISTORY = PriceHistory()
+HISTORY_SAVE_INTERVAL = int(os.getenv('HISTORY_SAVE_INTERVAL', 5 * 60))
+
+NFT_ALERTS = AlertBook()
+COIN_ALERTS = AlertBook(key=str.upper)
+
+PRICE_FEED_URL = os.getenv('PRICE_FEED_URL')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+background_started = False
+
+POLL_TICK = int(os.getenv('POLL_TICK', 15))
+NFT_SCHEDULE = PollScheduler(
+    min_interval=int(os.getenv('NFT_POLL_MIN_INTERVAL', 60)),
+    max_interval=int(os.getenv('NFT_POLL_MAX_INTERVAL', 60 * 60)),
+    budget=int(os.getenv('NFT_POLL_BUDGET', 60)) # OpenSea requests per minute
+)
+COIN_SCHEDULE = PollScheduler(
+    min_interval=int(os.getenv('COIN_POLL_MIN_INTERVAL', 60)),
+    max_interval=int(os.getenv('COIN_POLL_MAX_INTERVAL', 2 * 60 * 60)),
+    budget=int(os.getenv('COIN_POLL_BUDGET', 60 * COIN_BATCH_SIZE)) # symbols per minute, fetched in batches
+)
+
 TOKEN = os.getenv('DISCORD_TOKEN')
 COIN_API = os.getenv('COIN_API_KEY')
 EXCHANGE = os.getenv('CURRENCY_API_KEY')
 
-client = discord.Client()
+ratelimit.configure('pro-api.coinmarketcap.com', int(os.getenv('CMC_RATE_LIMIT', 30)))
+ratelimit.configure('api.opensea.io', int(os.getenv('OPENSEA_RATE_LIMIT', 240)))
+ratelimit.configure('free.currconv.com', int(os.getenv('CURRCONV_RATE_LIMIT', 2)))
+
+# hedging is off unless a delay is set, it spends an extra request on slow lookups
+http_client.configure('pro-api.coinmarketcap.com', timeout=float(os.getenv('CMC_TIMEOUT', 5)), hedge_after=float(os.getenv('CMC_HEDGE_AFTER', 0)))
+http_client.configure('api.opensea.io', timeout=float(os.getenv('OPENSEA_TIMEOUT', 5)), hedge_after=float(os.getenv('OPENSEA_HEDGE_AFTER', 0)))
+http_client.configure('free.currconv.com', timeout=float(os.getenv('CURRCONV_TIMEOUT', 10)))
+
+CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', 5))
+CIRCUIT_RESET = int(os.getenv('CIRCUIT_RESET', 60))
+for host in ('pro-api.coinmarketcap.com', 'api.opensea.io', 'free.currconv.com'):
+    circuit.configure(host, CIRCUIT_FAILURES, CIRCUIT_RESET)
+
+COMMAND_TIMEOUT = float(os.getenv('COMMAND_TIMEOUT', 15))
+
+# cost classes: answered from memory/SQLite, one provider call, coin and NFT providers together
+COMMAND_COSTS = {
+    'watchlist_clear': 'local',
+    'watchlist': 'local',
+    'history': 'local',
+    'currency': 'local',
+    'metrics': 'single',
+    'watch': 'multi',
+    'lookup': 'multi'
+}
+COMMANDS = CommandQueue(
+    {
+        'local': (int(os.getenv('LOCAL_COMMAND_WORKERS', 8)), int(os.getenv('LOCAL_COMMAND_QUEUE', 200))),
+        'single': (int(os.getenv('SINGLE_COMMAND_WORKERS', 4)), int(os.getenv('SINGLE_COMMAND_QUEUE', 50))),
+        'multi': (int(os.getenv('MULTI_COMMAND_WORKERS', 8)), int(os.getenv('MULTI_COMMAND_QUEUE', 100)))
+    },
+    max_per_user=int(os.getenv('COMMAND_MAX_PER_USER', 3)),
+    max_per_guild=int(os.getenv('COMMAND_MAX_PER_GUILD', 30))
+)
+# users already told the bot is busy, so a flood is not answered message by message
+SHED_NOTICES = TTLCache(maxsize=4096, ttl=60)
+
+CMC_HEADERS = {
+    'Accepts': 'application/json',
+    'X-CMC_PRO_API_KEY': COIN_API,
+}
+
+for name, cache in (('coin', COIN_CACHE), ('nft', NFT_CACHE), ('metrics', METRICS_CACHE), ('nft_misses', NFT_MISSES), ('render', RENDER_CACHE)):
+    instrumentation.register_cache(name, cache)
+
+ALERTS_EVALUATED = instrumentation.counter('alerts_evaluated_total', "Alerts checked against a fresh price")
+ALERTS_FIRED = instrumentation.counter('alerts_fired_total', "Alert notifications sent")
+PRICE_TICKS = instrumentation.counter('price_ticks_total', "Ticks received from the price feed")
+
+SHARD_COUNT = os.getenv('SHARD_COUNT')
+
+# shard_count=None lets Discord pick the recommended number of shards
+client = discord.AutoShardedClient(shard_count=int(SHARD_COUNT) if SHARD_COUNT else None)
 
 @client.event
 async def on_ready():
+    global background_started
     logging.debug(f'{client.user.name} connected to Discord')
 
-    count = 0
+    # on_ready fires again after every gateway reconnect, background work is only started once
+    if background_started:
+        return
+    background_started = True
+
+    await db.WRITER.flush()
+    load_alert_books()
+    COIN_INDEX.load(*db.get_coin_map())
+    HISTORY.load(db.get_price_history())
+    restore_poll_state()
+    load_guild_currencies()
+    DISPATCHER.start()
+    supervisor.start('fx', fx_loop)
+    if LISTINGS_LIMIT:
+        supervisor.start('listings', listings_loop)
+    supervisor.start('alerts', alert_loop)
+    supervisor.start('history', history_loop)
+    supervisor.start('event_loop_lag', instrumentation.monitor_loop_lag)
+    if PRICE_FEED_URL:
+        supervisor.start('price_feed', lambda: stream.run_feed(stream.get_source(PRICE_FEED_URL), on_price_tick))
+    await start_metrics_server()
+
+async def alert_loop():
+    ratelimit.PRIORITY.set(ratelimit.BACKGROUND)
 
     while True:
 
+        await refresh_coin_index()
+
         await nft_alert_runner()
+        await coin_alert_runner()
+
+        await asyncio.sleep(POLL_TICK)
+
+
+async def listings_loop():
+    ratelimit.PRIORITY.set(ratelimit.BACKGROUND)
+
+    while True:
+
+        await refresh_listings()
+
+        await asyncio.sleep(LISTINGS_REFRESH)
 
-        if count%24 == 0:
-            await coin_alert_runner()
+async def fx_loop():
+    ratelimit.PRIORITY.set(ratelimit.BACKGROUND)
 
-        count += 1
-        await asyncio.sleep(300)
+    while True:
+
+        refreshed = await refresh_fx_rates()
+
+        await asyncio.sleep(FX_REFRESH if refreshed else FX_RETRY)
 
+async def history_loop():
+    while True:
+        await asyncio.sleep(HISTORY_SAVE_INTERVAL)
+        save_history()
+
+def save_history():
+    now = time.time()
+    db.save_price_history(HISTORY.unsaved(), [(tier, now - retention) for tier, (_, retention) in enumerate(TIERS)])
+
+def restore_poll_state():
+    now = time.time()
+    for type, book, schedule in (('nft', NFT_ALERTS, NFT_SCHEDULE), ('coin', COIN_ALERTS, COIN_SCHEDULE)):
+        assets = set(book.assets())
+        dead = []
+        for asset, due, interval, price, observed in db.get_poll_state(type):
+            if asset not in assets:
+                dead.append(asset)
+                continue
+            schedule.restore(asset, due, interval, price, observed, now)
+            # the persisted history may already hold this price, or a later one
+            latest = HISTORY.get(type, asset).latest() if HISTORY.get(type, asset) else None
+            if price and observed and (latest is None or observed > latest[0]):
+                HISTORY.record(type, asset, price, t=observed)
+        # rows left behind by assets whose alerts fired, expired or were cleared while stopped
+        if dead:
+            db.delete_poll_state(type, dead)
+
+async def start_metrics_server():
+    if METRICS_PORT:
+        try:
+            await instrumentation.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logging.warning(f"Failed to start metrics endpoint - {e}")
+
+async def on_price_tick(type, asset, price):
+    PRICE_TICKS.inc(type=type)
+    book = get_alert_book(type)
+    # key history the way the book and !history do, e.g. upper case coin symbols
+    asset = book.key(asset)
+    # the feed carries far more assets than anyone asks about, only keep watched or looked up ones
+    if book.count(asset) or HISTORY.get(type, asset) is not None:
+        HISTORY.record(type, asset, price)
+    alerts = book.triggered(asset, price)
+    ALERTS_EVALUATED.inc(len(alerts), type=type)
+    for alert in alerts:
+        if type == 'nft':
+            await send_nft_alert(alert[9], alert[3], alert[1], price, alert[4], alert[0])
+        else:
+            await send_coin_alert(alert[9], alert[3], alert[1], price, alert[4], alert[0])
 
 async def nft_alert_runner():
     await check_nft_updates()
@@ -44,6 +262,10 @@ async def nft_alert_runner():
 async def coin_alert_runner():
     await check_coin_updates()
 
+@client.event
+async def on_shard_ready(shard_id):
+    logging.warning(f"{time.ctime()}: Shard {shard_id} ready")
+
 @client.event
 async def on_message(message):
     if message.author == client.user or not message.content.startswith('!'):
@@ -52,6 +274,37 @@ async def on_message(message):
     search_string = message.content[1:].strip()
     if search_string == '':
         return
+
+    command = get_command_type(search_string)
+    # DMs have no guild, so each user gets their own turn
+    guild = message.guild.id if message.guild else ('dm', message.author.id)
+    if not COMMANDS.submit(COMMAND_COSTS[command], guild, message.author.id, lambda: run_command(message, search_string, command)):
+        await notify_busy(message)
+
+async def run_command(message, search_string, command):
+    with instrumentation.timer('command_seconds', "Time to handle a command", command=command):
+        try:
+            await asyncio.wait_for(handle_command(message, search_string), COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"{time.ctime()}: Command <{search_string}> timed out after {COMMAND_TIMEOUT}s")
+            await message.channel.send("Sorry, that took too long - please try again shortly")
+
+async def notify_busy(message):
+    if SHED_NOTICES.get(message.author.id):
+        return
+    SHED_NOTICES.set(message.author.id, True)
+    await message.channel.send(f"Sorry <@{message.author.id}>, I'm handling a lot of requests right now - please try again in a moment")
+
+def get_command_type(search_string):
+    # matched the same way handle_command dispatches, anything else is a lookup
+    if search_string == 'metrics':
+        return 'metrics'
+    for command in ('watchlist clear', 'watchlist', 'watch', 'history', 'currency'):
+        if search_string.startswith(command):
+            return command.replace(' ', '_')
+    return 'lookup'
+
+async def handle_command(message, search_string):
     
     if search_string.startswith('watchlist clear nft'):
         clear_watchlist(str(message.author.id), 'nft')
@@ -87,7 +340,7 @@ async def on_message(message):
         if not watch_string or not modifiers:
             await message.channel.send(f"Enter an nft or cryptocurrency to watch followed by a price (ETH for nfts, $ for coins) to alert at (`!watch coolpetsnft 1.5`/`!watch eth 3000`)")
 
-        crypto_details, nft_details = get_details(watch_string)
+        crypto_details, nft_details = await get_details(watch_string)
         print(crypto_details, nft_details)
         if not any((crypto_details, nft_details)):
             await message.channel.send(f"Failed to find <{watch_string}>")
@@ -98,16 +351,16 @@ async def on_message(message):
                     await message.channel.send(f"Current price for {watch_string} (${crypto_details.get('USD')}) must be higher than alert price (${modifiers[0]})")
                     return
                 if coin_watchlist(watch_string, modifiers, str(message.author), str(message.author.id), message.channel.id):
-                    await message.channel.send(f"Added alert for {watch_string} at floor price {modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for 30 days")
+                    await message.channel.send(f"Added alert for {watch_string} at floor price {modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for {db.DEFAULT_WATCH_DAYS} days")
                     colour = get_colour(crypto_details.get('symbol', 'none'))
-                    msg = generate_crypto_message(crypto_details, colour)
+                    msg = generate_crypto_message(crypto_details, colour, get_guild_currency(message.guild))
                     await message.channel.send(embed=msg)
             else:
                 if float(modifiers[0]) > nft_details.get('floor'):
                     await message.channel.send(f"Current price for {watch_string} ({nft_details.get('floor')} ETH) must be higher than alert price ({modifiers[0]} ETH)")
                     return
                 if nft_watchlist(watch_string, modifiers, str(message.author), str(message.author.id), message.channel.id):
-                    await message.channel.send(f"Added alert for {watch_string} at floor price {modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for 30 days")
+                    await message.channel.send(f"Added alert for {watch_string} at floor price {modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for {db.DEFAULT_WATCH_DAYS} days")
                     colour = get_colour(nft_details.get('name', 'none'))
                     msg = generate_nft_message(nft_details, colour)
                     await message.channel.send(embed=msg)
@@ -117,28 +370,65 @@ async def on_message(message):
                 await message.channel.send(f"Current price for {watch_string} (${crypto_details.get('USD')}) must be higher than alert price (${modifiers[0]})")
                 return
             if coin_watchlist(watch_string, modifiers, str(message.author), str(message.author.id), message.channel.id):
-                await message.channel.send(f"Added alert for {watch_string} at price ${modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for 30 days")
+                await message.channel.send(f"Added alert for {watch_string} at price ${modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for {db.DEFAULT_WATCH_DAYS} days")
                 colour = get_colour(crypto_details.get('symbol', 'none'))
-                msg = generate_crypto_message(crypto_details, colour)
+                msg = generate_crypto_message(crypto_details, colour, get_guild_currency(message.guild))
                 await message.channel.send(embed=msg)
         if nft_details:
             if float(modifiers[0]) > nft_details.get('floor'):
                 await message.channel.send(f"Current price for {watch_string} ({nft_details.get('floor')} ETH) must be higher than alert price ({modifiers[0]} ETH)")
                 return
             if nft_watchlist(watch_string, modifiers, str(message.author), str(message.author.id), message.channel.id):
-                await message.channel.send(f"Added alert for {watch_string} at floor price {modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for 30 days")
+                await message.channel.send(f"Added alert for {watch_string} at floor price {modifiers[0]} (requested by <@{str(message.author.id)}>) - watching for {db.DEFAULT_WATCH_DAYS} days")
                 colour = get_colour(nft_details.get('name', 'none'))
                 msg = generate_nft_message(nft_details, colour)
                 await message.channel.send(embed=msg)
         return
     
+    if search_string.startswith('history'):
+        commands = search_string.split(' ')
+        if len(commands) < 2:
+            await message.channel.send("Enter a cryptocurrency or nft to show recorded prices for (`!history eth`/`!history coolpetsnft`)")
+            return
+        asset = commands[1]
+        for type, key in (('coin', asset.upper()), ('nft', asset)):
+            summary = HISTORY.summary(type, key)
+            if summary:
+                msg = generate_history_message(key, type, summary, get_colour(key))
+                await message.channel.send(embed=msg)
+                return
+        await message.channel.send(f"No price history recorded for <{asset}>")
+        return
+
+    if search_string.startswith('currency'):
+        commands = search_string.split(' ')
+        if len(commands) < 2:
+            await message.channel.send(f"Prices are shown in {get_guild_currency(message.guild)}. Server admins can change this with `!currency <code>` ({', '.join(FX_RATES.currencies)})")
+            return
+        if message.guild is None:
+            await message.channel.send("The currency can only be changed in a server")
+            return
+        if not message.author.guild_permissions.manage_guild:
+            await message.channel.send("You need the Manage Server permission to change the currency")
+            return
+        currency = commands[1].upper()
+        if not FX_RATES.supports(currency):
+            await message.channel.send(f"Unsupported currency <{commands[1]}> (choose from {', '.join(FX_RATES.currencies)})")
+            return
+        set_guild_currency(message.guild.id, currency)
+        await message.channel.send(f"Prices will now be shown in {currency}")
+        return
+
     if search_string == ('metrics'):
-        data = metrics()
+        data = await metrics()
+        if not data:
+            await message.channel.send("Failed to fetch global metrics")
+            return
         msg = generate_metrics_message(data, 0xFFD700)
         await message.channel.send(embed=msg)
         return
     
-    crypto_details, nft_details = get_details(search_string)
+    crypto_details, nft_details = await get_details(search_string)
     if not any((crypto_details, nft_details)):
         await message.channel.send(f"Failed to find <{search_string}>")
         return
@@ -146,14 +436,40 @@ async def on_message(message):
     #colour = get_colour(str(message.author))
     if crypto_details:
         colour = get_colour(crypto_details.get('symbol', 'none'))
-        msg = generate_crypto_message(crypto_details, colour)
+        msg = generate_crypto_message(crypto_details, colour, get_guild_currency(message.guild))
         await message.channel.send(embed=msg)
     if nft_details:
         colour = get_colour(nft_details.get('name', 'none'))
         msg = generate_nft_message(nft_details, colour)
         await message.channel.send(embed=msg)
     
-def generate_crypto_message(details, colour):
+def cached_render(builder):
+    """
+    Reuses the embed built for a quote snapshot and colour. Embeds are only
+    read when sent, so the same object can be handed out again. Stale quotes
+    get a footer saying so.
+    """
+    def render(details, colour, *args):
+        embed = builder(details, colour, *args)
+        if details.get('stale'):
+            embed.set_footer(text=STALE_FOOTER)
+        return embed
+
+    @functools.wraps(builder)
+    def wrapper(details, colour, *args):
+        version = details.get('version')
+        if version is None:
+            return render(details, colour, *args)
+        key = (builder.__name__, version, colour, bool(details.get('stale'))) + args
+        embed = RENDER_CACHE.get(key)
+        if embed is None:
+            embed = render(details, colour, *args)
+            RENDER_CACHE.set(key, embed)
+        return embed
+    return wrapper
+
+@cached_render
+def generate_crypto_message(details, colour, currency=None):
 
     embed=discord.Embed(
         title=f"{details.get('name','Unknown')} ({details.get('symbol','Unknown')})",
@@ -171,25 +487,15 @@ def generate_crypto_message(details, colour):
         inline=True
     )
     embed.add_field(name=chr(173), value=chr(173))
-    if details.get('USD') < 0.01:
-        usd = '${0:.10f}'.format(details.get('USD'))
-    else:
-        usd = f"${format(details.get('USD'), '.2f')}"
-    if details.get('GBP') < 0.01:
-        gbp = '£{0:.10f}'.format(details.get('GBP'))
-    else:
-        gbp = f"£{format(details.get('GBP'), '.2f')}"
-    embed.add_field(
-        name="Value (USD)",
-        value=usd,
-        inline=True
-    )
-    embed.add_field(
-        name="Value (GBP)",
-        value=gbp,
-        inline=True
-    ),
-    embed.add_field(name=chr(173), value=chr(173)),
+    currencies = list(dict.fromkeys(('USD', currency or FX_DEFAULT_CURRENCY)))
+    for code in currencies:
+        embed.add_field(
+            name=f"Value ({code})",
+            value=get_fiat_message(details.get('prices', {}).get(code), code),
+            inline=True
+        )
+    for _ in range(3 - len(currencies)):
+        embed.add_field(name=chr(173), value=chr(173))
     volume_change_str = f"1h: {get_volume_message(details.get('percent_1h'),2,'%')}\n24h: {get_volume_message(details.get('percent_24h'),2,'%')}\n7d: {get_volume_message(details.get('percent_7d'),2,'%')}\n30d: {get_volume_message(details.get('percent_30d'),2,'%')}"
     embed.add_field(
         name="Volume change",
@@ -198,6 +504,7 @@ def generate_crypto_message(details, colour):
     )
     return embed
 
+@cached_render
 def generate_nft_message(details, colour):
 
     if details.get('url'):
@@ -244,6 +551,7 @@ def generate_nft_message(details, colour):
     )
     return embed
 
+@cached_render
 def generate_metrics_message(details, colour):
 
     embed=discord.Embed(
@@ -315,13 +623,44 @@ def generate_metrics_message(details, colour):
     )
     return embed
 
+def generate_history_message(asset, type, summary, colour):
+    embed=discord.Embed(
+        title=f"{asset} Price History",
+        color=colour
+    )
+    embed.add_field(
+        name="Latest",
+        value=get_unit_from_type(summary.get('latest'), type),
+        inline=True
+    )
+    embed.add_field(
+        name="7d Low",
+        value=get_unit_from_type(summary.get('low'), type),
+        inline=True
+    )
+    embed.add_field(
+        name="7d High",
+        value=get_unit_from_type(summary.get('high'), type),
+        inline=True
+    )
+    change_str = f"1h: {get_volume_message(summary.get('change_1h'),2,'%')}\n24h: {get_volume_message(summary.get('change_24h'),2,'%')}\n7d: {get_volume_message(summary.get('change_7d'),2,'%')}"
+    embed.add_field(
+        name="Change",
+        value=change_str,
+        inline=False
+    )
+    embed.set_footer(
+        text=f"{summary.get('points')} recorded prices, last at {time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(summary.get('updated')))}"
+    )
+    return embed
+
 def generate_watchlist_message(type, alerts, colour):
     embed=discord.Embed(
         title=f"Active {'NFT' if type.lower() == 'nft' else 'Cryptocurrency'} Alerts",
         color=colour
     )
     for a in alerts:
-        s = f"{get_unit_from_type(a[4],type)} ({get_remaining_time(type, a[6])} hours remaining)"
+        s = f"{get_unit_from_type(a[4],type)} ({get_remaining_time(a[10])} hours remaining)"
         embed.add_field(
             name=a[1].upper(),
             value=s,
@@ -333,12 +672,9 @@ def generate_watchlist_message(type, alerts, colour):
     )
     return embed
 
-def get_remaining_time(type, calls):
-    if type.lower() == 'nft':
-        per_hour = 12
-    else:
-        per_hour = 0.5
-    return round(calls / per_hour)
+def get_remaining_time(expires_at):
+    expires = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S')
+    return max(round((expires - datetime.utcnow()).total_seconds() / 3600), 0)
 
 def get_volume_message(m, places, symbol=''):
     if m:
@@ -346,6 +682,13 @@ def get_volume_message(m, places, symbol=''):
         return f"{emoji} {round(m,places)}{symbol}"
     return 'unknown'
 
+def get_fiat_message(value, currency):
+    if value is None:
+        return 'Unknown'
+    if value < 0.01:
+        return f"{fx.symbol(currency)}{value:.10f}"
+    return f"{fx.symbol(currency)}{value:.2f}"
+
 def get_unit_from_type(message, type):
     if type.lower() == 'nft':
         return f'{message} ETH'
@@ -359,59 +702,51 @@ async def on_error(event, *args, **kwargs):
         else:
             raise
 
+@functools.lru_cache(maxsize=4096)
 def get_colour(name):
-    s1, s2 = "salt1", "salt2"
-    r1 = get_num(name)
-    r2 = get_num(name+s1)
-    r3 = get_num(name+s2)
-
-    s = '0x%02X%02X%02X' % (r1,r2,r3)
-    logging.debug(f"Generated {s} based on {name}")
-    return int(s, 16)
-
-def to_number(s):
-    return int.from_bytes(s.encode(), 'little')
-
-def get_num(name):
-    random.seed(to_number(name))
-    return random.randint(0,255)
+    colour = int.from_bytes(hashlib.blake2b(name.encode(), digest_size=3).digest(), 'big')
+    logging.debug(f"Generated {hex(colour)} based on {name}")
+    return colour
 
 def add_commas(x):
     return "{:,}".format(x)
 
-def get_details(code):
+async def get_details(code):
 
     logging.debug(f"searching for {code}")
 
-    coin_data = get_coin_data(code)
-    nft_data = get_nft_data(code)
+    coin_data, nft_data = await asyncio.gather(get_coin_data(code), get_nft_data(code))
 
     return coin_data, nft_data
 
-def get_coin_price(symbol):
+async def get_coin_price(symbol):
 
-    price_data = get_coin_data(symbol, symbol_only=True)
-    return price_data.get("USD")
+    price_data = await get_coin_data(symbol, symbol_only=True)
+    return price_data.get("USD") if price_data else None
 
-def get_coin_data(code, symbol_only=False):
+@cached(COIN_CACHE, key=lambda code, symbol_only=False: (code.lower(), symbol_only), stale=COIN_STALE)
+async def get_coin_data(code, symbol_only=False):
 
-    url = 'https://pro-api.coinmarketcap.com/v2/cryptocurrency/quotes/latest'
+    listed = get_listed(code, symbol_only)
+    if listed:
+        return collect_data(listed)
 
-    headers = {
-        'Accepts': 'application/json',
-        'X-CMC_PRO_API_KEY': COIN_API,
-    }
+    url = 'https://pro-api.coinmarketcap.com/v2/cryptocurrency/quotes/latest'
 
-    session = Session()
-    session.headers.update(headers)
+    if COIN_INDEX:
+        symbol_data, slug_data = await call_indexed(code, url, symbol_only)
+    elif symbol_only:
+        symbol_data = await call_symbol(code, url)
+        slug_data = None
+    else:
+        symbol_data, slug_data = await asyncio.gather(
+            call_symbol(code, url),
+            call_slug(code, url)
+        )
 
     if symbol_only:
-        symbol_data = call_symbol(code, url, session)
-        data = collect_data(symbol_data)
-        return data
+        return collect_data(symbol_data) if symbol_data else None
 
-    symbol_data = call_symbol(code, url, session)
-    slug_data = call_slug(code, url, session)
     symbol_cap = get_market_cap(symbol_data)
     slug_cap = get_market_cap(slug_data)
     
@@ -427,25 +762,119 @@ def get_coin_data(code, symbol_only=False):
     data = collect_data(raw_data)
     return data
 
-def get_nft_data(code):
+def get_listed(code, symbol_only=False):
+    """
+    Best match for code in the listings snapshot. Listed coins have a larger
+    market cap than any coin outside it, so a match needs no request.
+    """
+    if not LISTINGS.fresh(time.time(), LISTINGS_MAX_AGE):
+        return None
+
+    symbol_entry, slug_entry = LISTINGS.resolve(code)
+    if symbol_only or not slug_entry:
+        return symbol_entry
+    if not symbol_entry:
+        return slug_entry
+
+    return symbol_entry if (get_market_cap(symbol_entry) or 0) > (get_market_cap(slug_entry) or 0) else slug_entry
+
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='call_indexed')
+async def call_indexed(code, url, symbol_only=False):
+
+    symbol_entry, slug_entry = COIN_INDEX.resolve(code)
+    if symbol_only:
+        slug_entry = None
+    ids = {str(entry[0]) for entry in (symbol_entry, slug_entry) if entry}
+    if not ids:
+        return None, None
+
+    parameters = {
+        'id':','.join(sorted(ids))
+    }
+
+    raw_data = await http_client.get_json(url, params=parameters, headers=CMC_HEADERS)
+    symbol_data = safeget(raw_data, 'data', str(symbol_entry[0])) if symbol_entry else None
+    slug_data = safeget(raw_data, 'data', str(slug_entry[0])) if slug_entry else None
+
+    return symbol_data, slug_data
+
+async def refresh_coin_index():
+
+    if time.time() - COIN_INDEX.updated < COIN_MAP_REFRESH:
+        return
+
+    url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/map'
+
+    entries = []
+    start = 1
+    while True:
+        parameters = {
+            'start':str(start),
+            'limit':str(COIN_MAP_PAGE_SIZE)
+        }
+        raw_data = await http_client.get_json(url, params=parameters, headers=CMC_HEADERS)
+        page = safeget(raw_data, 'data')
+        if page is None:
+            logging.warning(f"{time.ctime()}: Failed to refresh coin map")
+            return
+        entries += [(c.get('id'), c.get('symbol'), c.get('slug'), c.get('name'), c.get('rank')) for c in page if c.get('symbol') and c.get('slug')]
+        if len(page) < COIN_MAP_PAGE_SIZE:
+            break
+        start += COIN_MAP_PAGE_SIZE
+
+    updated = time.time()
+    db.replace_coin_map(entries, updated)
+    COIN_INDEX.load(entries, updated)
+    logging.warning(f"{time.ctime()}: Refreshed coin map ({len(entries)} coins)")
+
+async def refresh_listings():
+
+    url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest'
+
+    entries = []
+    start = 1
+    while start <= LISTINGS_LIMIT:
+        limit = min(LISTINGS_LIMIT - start + 1, LISTINGS_PAGE_SIZE)
+        parameters = {
+            'start':str(start),
+            'limit':str(limit),
+            'convert':'USD'
+        }
+        raw_data = await http_client.get_json(url, params=parameters, headers=CMC_HEADERS)
+        page = safeget(raw_data, 'data')
+        if page is None:
+            logging.warning(f"{time.ctime()}: Failed to refresh listings")
+            return
+        entries += [c for c in page if c.get('id') and c.get('symbol') and c.get('slug')]
+        if len(page) < limit:
+            break
+        start += limit
+
+    LISTINGS.load(entries, time.time())
+    logging.debug(f"Refreshed listings ({len(entries)} coins)")
+
+@cached(NFT_CACHE, key=lambda code: code, stale=NFT_STALE)
+async def get_nft_data(code):
+
+    if NFT_MISSES.get(code):
+        return None
     
     url = f'https://api.opensea.io/api/v1/collection/{code}'
 
-    data = call_nft_slug(url)
+    data = await call_nft_slug(url)
+    # a failing provider is not evidence that the collection does not exist
+    if data is None and http_client.healthy(url):
+        NFT_MISSES.set(code, True)
 
     return data
 
 
-def call_nft_slug(url):
-
-    try:
-        response = request("GET", url)
-        raw_data = json.loads(response.text)
-    except (ConnectionError, Timeout, TooManyRedirects) as e:
-        logging.warn(e)
-        return None
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='call_nft_slug')
+async def call_nft_slug(url):
 
-    if not raw_data.get('collection'):
+    # the ETH price is fetched alongside so collect_nft_data finds it cached
+    raw_data, _ = await asyncio.gather(http_client.get_json(url), get_coin_price('ETH'))
+    if not raw_data or not raw_data.get('collection'):
         return None
 
     owners = safeget(raw_data, 'collection', 'stats', 'num_owners')
@@ -456,34 +885,31 @@ def call_nft_slug(url):
     if owners < 2 or cap < 10:
         return None
 
-    data = collect_nft_data(raw_data)
+    data = await collect_nft_data(raw_data)
 
     return data
 
-def get_nft_floor(code):
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='get_nft_floor')
+async def get_nft_floor(code):
 
-    url = f'https://api.opensea.io/api/v1/collection/{code}'
+    # the stats endpoint is a fraction of the size of the full collection document
+    url = f'https://api.opensea.io/api/v1/collection/{code}/stats'
 
-    try:
-        response = request("GET", url)
-        raw_data = json.loads(response.text)
-    except (ConnectionError, Timeout, TooManyRedirects) as e:
-        logging.warn(e)
+    raw_data = await http_client.get_json(url, conditional=True)
+    if not raw_data or not raw_data.get('stats'):
         return None
 
-    if not raw_data.get('collection'):
-        return None
-
-    floor = safeget(raw_data, 'collection', 'stats', 'floor_price')
+    floor = safeget(raw_data, 'stats', 'floor_price')
 
     return floor if floor else 0
 
-def collect_nft_data(data):
+async def collect_nft_data(data):
 
     stats = safeget(data, 'collection', 'stats')
     eth_floor_price = stats.get("floor_price")
+    HISTORY.record('nft', safeget(data, 'collection', 'slug'), eth_floor_price)
     eth_market_cap = stats.get("market_cap")
-    eth_price = get_coin_price('ETH')
+    eth_price = await get_coin_price('ETH')
     if eth_price:
         usd_floor_price = eth_floor_price * eth_price if eth_floor_price else None
         usd_market_cap = eth_market_cap * eth_price if eth_market_cap else None
@@ -500,22 +926,21 @@ def collect_nft_data(data):
         "cap_usd": usd_market_cap,
         "floor": eth_floor_price,
         "floor_usd": usd_floor_price,
-        "url": safeget(data, 'collection', 'external_url')
+        "url": safeget(data, 'collection', 'external_url'),
+        "version": next(SNAPSHOT_VERSIONS)
     }
 
     return data
     
-def call_slug(code, url, session):
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='call_slug')
+async def call_slug(code, url):
 
     parameters = {
         'slug':code.lower()
     }
 
-    try:
-        response = session.get(url, params=parameters)
-        raw_data = json.loads(response.text)
-    except (ConnectionError, Timeout, TooManyRedirects) as e:
-        logging.warn(e)
+    raw_data = await http_client.get_json(url, params=parameters, headers=CMC_HEADERS)
+    if not raw_data:
         return None
 
     key = get_key(raw_data)
@@ -523,17 +948,15 @@ def call_slug(code, url, session):
 
     return data
 
-def call_symbol(code, url, session):
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='call_symbol')
+async def call_symbol(code, url):
 
     parameters = {
         'symbol':code.upper()
     }
 
-    try:
-        response = session.get(url, params=parameters)
-        raw_data = json.loads(response.text)
-    except (ConnectionError, Timeout, TooManyRedirects) as e:
-        logging.warning(e)
+    raw_data = await http_client.get_json(url, params=parameters, headers=CMC_HEADERS)
+    if not raw_data:
         return None
 
     key = get_key(raw_data)
@@ -541,6 +964,46 @@ def call_symbol(code, url, session):
 
     return data
 
+async def get_coin_prices(symbols):
+
+    url = 'https://pro-api.coinmarketcap.com/v2/cryptocurrency/quotes/latest'
+
+    symbols = sorted({s.upper() for s in symbols})
+
+    prices = {}
+    if LISTINGS.fresh(time.time(), LISTINGS_MAX_AGE):
+        for symbol in symbols:
+            price = LISTINGS.price(symbol)
+            if price is not None:
+                prices[symbol] = price
+        # only the long tail is requested per coin
+        symbols = [s for s in symbols if s not in prices]
+
+    chunks = [symbols[i:i+COIN_BATCH_SIZE] for i in range(0, len(symbols), COIN_BATCH_SIZE)]
+    responses = await asyncio.gather(*(call_symbols(chunk, url) for chunk in chunks))
+
+    for chunk, raw_data in zip(chunks, responses):
+        if not raw_data:
+            continue
+        for symbol in chunk:
+            price = safeget(fetch_from_dict_symbol(raw_data, symbol), 'quote', 'USD', 'price')
+            if price is not None:
+                prices[symbol] = price
+
+    return prices
+
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='call_symbols')
+async def call_symbols(codes, url):
+
+    parameters = {
+        'symbol':','.join(codes),
+        'skip_invalid':'true'
+    }
+
+    raw_data = await http_client.get_json(url, params=parameters, headers=CMC_HEADERS)
+
+    return raw_data
+
 
 def get_market_cap(data):
 
@@ -561,20 +1024,42 @@ def fetch_from_dict_symbol(data, key):
 def fetch_from_dict_slug(data, key):
     return safeget(data, 'data', key)
 
-def get_fx_rate():
-    url = f"https://free.currconv.com/api/v7/convert?q=USD_GBP&compact=ultra&apiKey={EXCHANGE}"
-    response = get(url)
-    return response.json().get('USD_GBP',0)
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='refresh_fx_rates')
+async def refresh_fx_rates():
+    url = "https://free.currconv.com/api/v7/convert"
+
+    pairs = [f"USD_{currency}" for currency in FX_RATES.currencies if currency != 'USD']
+    if not pairs:
+        return True
+    chunks = [pairs[i:i+FX_PAIRS_PER_REQUEST] for i in range(0, len(pairs), FX_PAIRS_PER_REQUEST)]
+    responses = await asyncio.gather(*(
+        http_client.get_json(url, params={'q':','.join(chunk), 'compact':'ultra', 'apiKey':EXCHANGE})
+        for chunk in chunks
+    ))
+
+    # rates from a chunk that failed are kept from the previous refresh
+    rates = dict(FX_RATES.rates)
+    refreshed = False
+    for chunk, raw_data in zip(chunks, responses):
+        for pair in chunk:
+            rate = raw_data.get(pair) if isinstance(raw_data, dict) else None
+            # error bodies like {"status":400,"error":...} carry no pairs and are skipped
+            if isinstance(rate, (int, float)) and rate > 0:
+                rates[pair.split('_')[-1]] = rate
+                refreshed = True
+
+    if not refreshed:
+        logging.warning(f"{time.ctime()}: Failed to refresh FX rates")
+        return False
+    FX_RATES.load(rates, time.time())
+    return True
 
 def collect_data(data):
 
-    quote = safeget(data, 'quote', 'USD')
+    quote = safeget(data, 'quote', 'USD') or {}
+    usd = quote.get('price')
+    HISTORY.record('coin', data.get('symbol'), usd)
 
-    if quote:
-        usd = quote.get('price')
-        fx_rate_usd_gbp = get_fx_rate()
-        gbp = fx_rate_usd_gbp * usd
-    
     data = {
         "name": data.get('name'),
         "symbol": data.get('symbol'),
@@ -582,11 +1067,12 @@ def collect_data(data):
         "rank": data.get('cmc_rank'),
         "fiat": True if data.get('is_fiat') == 1 else False,
         "USD": usd,
-        "GBP": gbp,
+        "prices": FX_RATES.convert(usd),
         "percent_1h": quote.get('percent_change_1h'),
         "percent_24h": quote.get('percent_change_24h'),
         "percent_7d": quote.get('percent_change_7d'),
-        "percent_30d": quote.get('percent_change_30d')
+        "percent_30d": quote.get('percent_change_30d'),
+        "version": next(SNAPSHOT_VERSIONS)
     }
 
     return data
@@ -595,23 +1081,14 @@ def collect_data(data):
 def round_to_n(x, n):
     return round(x, -int(floor(log10(abs(x))))+(n-1))
 
-def metrics():
+@cached(METRICS_CACHE, key=lambda: 'global', stale=METRICS_STALE)
+@instrumentation.timed('upstream_seconds', "Time spent on upstream requests", call='metrics')
+async def metrics():
     
     url = 'https://pro-api.coinmarketcap.com/v1/global-metrics/quotes/latest'
 
-    headers = {
-        'Accepts': 'application/json',
-        'X-CMC_PRO_API_KEY': COIN_API,
-    }
-
-    session = Session()
-    session.headers.update(headers)
-
-    try:
-        response = session.get(url)
-        raw_data = json.loads(response.text)
-    except (ConnectionError, Timeout, TooManyRedirects) as e:
-        logging.warning(e)
+    raw_data = await http_client.get_json(url, headers=CMC_HEADERS)
+    if not raw_data:
         return None
     
     data = collect_metric_data(raw_data)
@@ -633,7 +1110,8 @@ def collect_metric_data(raw_data):
         "stablecoin_cap": safeget(raw_data, 'data', 'stablecoin_market_cap'),
         "stablecoin_cap_24h_change": safeget(raw_data, 'data', 'stablecoin_24h_percentage_change'),
         "market_cap_usd": safeget(raw_data, 'data', 'quote', 'USD', 'total_market_cap'),
-        "market_cap_usd_24h_change": safeget(raw_data, 'data', 'quote', 'USD', 'total_market_cap_yesterday_percentage_change')
+        "market_cap_usd_24h_change": safeget(raw_data, 'data', 'quote', 'USD', 'total_market_cap_yesterday_percentage_change'),
+        "version": next(SNAPSHOT_VERSIONS)
     }
 
     return data
@@ -648,132 +1126,113 @@ def nft_watchlist(item, modifiers, requester, requester_id, channel_id):
     return True
 
 def add_to_nft_watchlist(item, alert_floor, requester, requester_id, channel_id):
-    
-    default_watch_duration = 12 * 24 * 30 # 1 month of every 5 minutes
-
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO nft_watchlist "
-            "(name, requester, requester_id, alert_value, triggered, watch_limit, time_added, active, channel_id)"
-            "VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?)",
-            (item, requester, requester_id, alert_floor, 0, default_watch_duration, 'Y', channel_id)
-        )
-        conn.commit()
 
-    print(f"Added alert for {item} at floor price {alert_floor} (requested by <@{requester_id}>) - watching for {default_watch_duration} seconds")
+    NFT_ALERTS.add(db.add_to_watchlist('nft', item, alert_floor, requester, requester_id, channel_id))
+
+    print(f"Added alert for {item} at floor price {alert_floor} (requested by <@{requester_id}>) - watching for {db.DEFAULT_WATCH_DAYS} days")
 
 async def check_nft_updates():
-    logging.warning(f"{time.ctime()}: Updating NFT alerts")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * "
-        "FROM nft_watchlist "
-        "WHERE active=?;",
-        ('Y',)
+    db.expire_alerts('nft')
+    NFT_ALERTS.expire(datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+
+    now = time.time()
+    forgotten = NFT_SCHEDULE.sync(NFT_ALERTS.assets(), now)
+    if forgotten:
+        db.delete_poll_state('nft', forgotten)
+    assets = NFT_SCHEDULE.due(now)
+    if not assets:
+        return
+    logging.warning(f"{time.ctime()}: Updating NFT alerts for {len(assets)} of {len(NFT_SCHEDULE)} assets")
+
+    prices = {}
+    try:
+        with instrumentation.timer('alert_cycle_seconds', "Time to poll and evaluate due assets", type='nft'):
+            prices = await nft_alert(NFT_ALERTS, assets)
+    finally:
+        # due() took these off the schedule, they must be requeued even if the cycle failed
+        for asset in assets:
+            NFT_SCHEDULE.observe(asset, prices.get(asset), NFT_ALERTS.thresholds(asset), now)
+        db.save_poll_state('nft', [(asset,) + NFT_SCHEDULE.state(asset) for asset in assets])
+
+async def nft_alert(book, slugs):
+
+    floors = await asyncio.gather(*(get_nft_floor(slug) for slug in slugs))
+    found = {slug: price for slug, price in zip(slugs, floors) if price is not None}
+    for slug, price in found.items():
+        HISTORY.record('nft', slug, price)
+    for slug, price in found.items():
+        alerts = book.triggered(slug, price)
+        ALERTS_EVALUATED.inc(book.count(slug), type='nft')
+        for alert in alerts:
+            await send_nft_alert(alert[9], alert[3], alert[1], price, alert[4], alert[0])
+
+    return found
+
+async def send_nft_alert(channel_id, requester_id, item, value, alert_value, alert_id):
+    DISPATCHER.submit(
+        ('nft', alert_id),
+        channel_id,
+        f"Heads up <@{requester_id}>, {item} just hit {value} ETH floor (you set up an alert for {alert_value} ETH)"
     )
-    jobs = cur.fetchall()
-    await nft_alert(jobs)
 
-async def nft_alert(alert_data):
+async def get_alert_channel(channel_id):
+    """
+    Returns the channel for an alert if the shard that owns it is connected.
+    Channels missing from the cache (e.g. their shard is still starting) are
+    fetched over HTTP. None means the alert should be retried later.
+    """
+    channel = client.get_channel(channel_id)
+    if channel is None:
+        try:
+            channel = await client.fetch_channel(channel_id)
+        except discord.HTTPException as e:
+            logging.warning(f"Failed to fetch channel {channel_id} - {e}")
+            return None
+    guild = getattr(channel, 'guild', None)
+    if guild is not None and client.shard_count:
+        # fetched channels only carry a discord.Object for the guild, so work the shard out from its id
+        shard = client.get_shard((guild.id >> 22) % client.shard_count)
+        if shard is None or shard.is_closed():
+            return None
+    return channel
 
-    found = {}
-    for alert in alert_data:
-        slug = alert[1]
-        if found.get(slug):
-            price = found.get(slug)
-        else:
-            price = get_nft_floor(slug)
-            found[slug] = price
-        channel_id = alert[9]
-        requester_id = alert[3]
-        if price <= alert[4]:
-            await send_nft_alert(channel_id, requester_id, alert[1], price, alert[4], str(alert[0]))
-    
-    for alert in alert_data:
-        decrement_watch_limit(str(alert[0]), 'nft')
+def on_alerts_sent(keys):
+    for type, alert_id in keys:
+        update_after_alert(alert_id, type)
+        ALERTS_FIRED.inc(type=type)
 
-def decrement_watch_limit(alert_id, type):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        if type == 'nft':
-            cur.execute(
-                "UPDATE nft_watchlist "
-                "SET watch_limit=watch_limit-1 "
-                "WHERE alert_id=?",
-                (alert_id,)
-            )
-            conn.commit()
-            cur.execute(
-                "SELECT watch_limit "
-                "FROM nft_watchlist "
-                "WHERE alert_id=?",
-                (alert_id,)
-            )
-            res = cur.fetchone()[0]
-            if res <= 0:
-                cur.execute(
-                    "UPDATE nft_watchlist "
-                    "SET active='N' "
-                    "WHERE alert_id=?",
-                    (alert_id,)
-                )
-                conn.commit()
-        else:
-            cur.execute(
-                "UPDATE coin_watchlist "
-                "SET watch_limit=watch_limit-1 "
-                "WHERE alert_id=?",
-                (alert_id,)
-            )
-            conn.commit()
-            cur.execute(
-                "SELECT watch_limit "
-                "FROM coin_watchlist "
-                "WHERE alert_id=?",
-                (alert_id,)
-            )
-            res = cur.fetchone()[0]
-            if res <= 0:
-                cur.execute(
-                    "UPDATE coin_watchlist "
-                    "SET active='N' "
-                    "WHERE alert_id=?",
-                    (alert_id,)
-                )
-                conn.commit()
+DISPATCHER = AlertDispatcher(get_alert_channel, on_alerts_sent, concurrency=int(os.getenv('ALERT_SEND_CONCURRENCY', 10)))
 
-async def send_nft_alert(channel_id, requester_id, item, value, alert_value, alert_id):
-    try:
-        channel = client.get_channel(channel_id)
-        await channel.send(f"Heads up <@{requester_id}>, {item} just hit {value} ETH floor (you set up an alert for {alert_value} ETH)")
-        update_after_alert(alert_id, 'nft')
-    except Exception as e:
-        print(f"Failed to send message to channel {channel} ({channel_id})")
-        print(e)
+def get_guild_currency(guild):
+    currency = GUILD_CURRENCIES.get(guild.id) if guild else None
+    return currency if currency and FX_RATES.supports(currency) else FX_DEFAULT_CURRENCY
+
+def set_guild_currency(guild_id, currency):
+    db.set_guild_currency(guild_id, currency)
+    GUILD_CURRENCIES[guild_id] = currency
 
+def load_guild_currencies():
+    GUILD_CURRENCIES.clear()
+    GUILD_CURRENCIES.update(db.get_guild_currencies())
 
 def update_after_alert(alert_id, type):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        if type == 'nft':
-            cur.execute(
-                "UPDATE nft_watchlist "
-                "SET triggered=triggered+1, active=?"
-                "WHERE alert_id=?",
-                ('N', alert_id)
-            )
-            conn.commit()
-        else:
-            cur.execute(
-                "UPDATE coin_watchlist "
-                "SET triggered=triggered+1, active=?"
-                "WHERE alert_id=?",
-                ('N', alert_id)
-            )
-            conn.commit()
+    db.update_after_alert(alert_id, type)
+    get_alert_book(type).remove(alert_id)
+
+def clear_watchlist(requester_id, type):
+    db.clear_watchlist(requester_id, type)
+    get_alert_book(type).remove_requester(requester_id)
+
+def get_user_alerts(requester_id):
+    # served from the alert books, which already include writes still queued for the database
+    return COIN_ALERTS.requester_alerts(requester_id), NFT_ALERTS.requester_alerts(requester_id)
 
+def get_alert_book(type):
+    return NFT_ALERTS if type.lower() == 'nft' else COIN_ALERTS
+
+def load_alert_books():
+    NFT_ALERTS.load(db.get_active_alerts('nft'))
+    COIN_ALERTS.load(db.get_active_alerts('coin'))
 
 def coin_watchlist(item, modifiers, requester, requester_id, channel_id):
     coin_jobs, _ = get_user_alerts(requester_id)
@@ -785,104 +1244,53 @@ def coin_watchlist(item, modifiers, requester, requester_id, channel_id):
     return True
 
 def add_to_coin_watchlist(item, alert_floor, requester, requester_id, channel_id):
-    
-    default_watch_duration = 0.5 * 24 * 30 # 1 month of every 2 hours
-
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO coin_watchlist "
-            "(name, requester, requester_id, alert_value, triggered, watch_limit, time_added, active, channel_id)"
-            "VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?, ?)",
-            (item, requester, requester_id, alert_floor, 0, default_watch_duration, 'Y', channel_id)
-        )
-        conn.commit()
 
-    print(f"Added alert for {item} at floor price {alert_floor} (requested by <@{requester_id}>) - watching for {default_watch_duration} seconds")
-
-async def check_coin_updates():
-    logging.warning(f"{time.ctime()}: Updating cryptocurrency alerts")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * "
-        "FROM coin_watchlist "
-        "WHERE active=?;",
-        ('Y',)
-    )
-    jobs = cur.fetchall()
-    await coin_alert(jobs)
+    COIN_ALERTS.add(db.add_to_watchlist('coin', item, alert_floor, requester, requester_id, channel_id))
 
-async def coin_alert(alert_data):
+    print(f"Added alert for {item} at floor price {alert_floor} (requested by <@{requester_id}>) - watching for {db.DEFAULT_WATCH_DAYS} days")
 
-    found = {}
-    for alert in alert_data:
-        symbol = alert[1]
-        if found.get(symbol):
-            price = found.get(symbol)
-        else:
-            data = get_coin_data(symbol, symbol_only=True)
-            price = data.get('USD')
-            found[symbol] = price
-        channel_id = alert[9]
-        requester_id = alert[3]
-        if price <= alert[4]:
-            await send_coin_alert(channel_id, requester_id, alert[1], price, alert[4], str(alert[0]))
-    
-    for alert in alert_data:
-        decrement_watch_limit(str(alert[0]), 'coin')
+async def check_coin_updates():
+    db.expire_alerts('coin')
+    COIN_ALERTS.expire(datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+
+    now = time.time()
+    forgotten = COIN_SCHEDULE.sync(COIN_ALERTS.assets(), now)
+    if forgotten:
+        db.delete_poll_state('coin', forgotten)
+    assets = COIN_SCHEDULE.due(now)
+    if not assets:
+        return
+    logging.warning(f"{time.ctime()}: Updating cryptocurrency alerts for {len(assets)} of {len(COIN_SCHEDULE)} assets")
 
-async def send_coin_alert(channel_id, requester_id, item, value, alert_value, alert_id):
+    prices = {}
     try:
-        channel = client.get_channel(channel_id)
-        await channel.send(f"Heads up <@{requester_id}>, {item} just hit ${value} (you set up an alert for ${alert_value})")
-        update_after_alert(alert_id, 'coin')
-    except Exception as e:
-        print(f"Failed to send message to channel {channel} ({channel_id})")
-        print(e)
-
-def get_user_alerts(requester_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT * "
-            "FROM nft_watchlist "
-            "WHERE requester_id=? "
-            "AND active='Y';",
-            (requester_id,)
-        )
-        nft_jobs = cur.fetchall()
-        cur.execute(
-            "SELECT * "
-            "FROM coin_watchlist "
-            "WHERE requester_id=? "
-            "AND active='Y';",
-            (requester_id,)
-        )
-        coin_jobs = cur.fetchall()
-        return coin_jobs, nft_jobs
-
-def clear_watchlist(requester_id, type):
-    with sqlite3.connect(DB_PATH) as conn:
-        cur = conn.cursor()
-        if type.lower() == 'nft':
-            cur.execute(
-                "UPDATE nft_watchlist "
-                "SET active='N' "
-                "WHERE requester_id=? "
-                "AND active='Y';",
-                (requester_id,)
-            )
-        else:
-            cur.execute(
-                "UPDATE coin_watchlist "
-                "SET active='N' "
-                "WHERE requester_id=? "
-                "AND active='Y';",
-                (requester_id,)
-            )
-        conn.commit()
+        with instrumentation.timer('alert_cycle_seconds', "Time to poll and evaluate due assets", type='coin'):
+            prices = await coin_alert(COIN_ALERTS, assets)
+    finally:
+        # due() took these off the schedule, they must be requeued even if the cycle failed
+        for asset in assets:
+            COIN_SCHEDULE.observe(asset, prices.get(asset), COIN_ALERTS.thresholds(asset), now)
+        db.save_poll_state('coin', [(asset,) + COIN_SCHEDULE.state(asset) for asset in assets])
+
+async def coin_alert(book, symbols):
+
+    prices = await get_coin_prices(symbols)
+    for symbol, price in prices.items():
+        HISTORY.record('coin', symbol, price)
+    for symbol, price in prices.items():
+        alerts = book.triggered(symbol, price)
+        ALERTS_EVALUATED.inc(book.count(symbol), type='coin')
+        for alert in alerts:
+            await send_coin_alert(alert[9], alert[3], alert[1], price, alert[4], alert[0])
+
+    return prices
 
+async def send_coin_alert(channel_id, requester_id, item, value, alert_value, alert_id):
+    DISPATCHER.submit(
+        ('coin', alert_id),
+        channel_id,
+        f"Heads up <@{requester_id}>, {item} just hit ${value} (you set up an alert for ${alert_value})"
+    )
 
 def safeget(dct: dict, *keys):
     """
@@ -900,5 +1308,25 @@ def safeget(dct: dict, *keys):
             return None
     return dct
 
+def request_shutdown():
+    # closing the client makes client.start return, so the cleanup below flushes queued writes
+    asyncio.ensure_future(client.close())
+
 if __name__ == "__main__":
-    client.run(TOKEN)
+    # client.run is not used, so install the SIGINT/SIGTERM handling it would have
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            client.loop.add_signal_handler(sig, request_shutdown)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        client.loop.run_until_complete(client.start(TOKEN))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop.run_until_complete(supervisor.stop())
+        client.loop.run_until_complete(client.close())
+        client.loop.run_until_complete(http_client.close())
+        save_history()
+        db.close()
+        client.loop.close()
@@ -0,0 +1,112 @@
+# cache.py
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache:
+    """
+    Size bounded mapping whose entries expire ttl seconds after being set.
+    The least recently used entry is evicted once maxsize is reached.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+        if item is not _MISSING:
+            expires, value = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "hit_rate": self.hits / total if total else 0
+        }
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key so only the first runs and
+    every caller receives its result.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.shared += 1
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+def cached(cache, key=None, stale=None):
+    """
+    Caches the result of a coroutine function in cache. Concurrent misses for
+    the same key share one call. Falsy results (failed lookups) are not
+    stored so they are retried on the next call.
+
+    With a stale cache, the last good result is kept there for longer and
+    returned in place of a failed call, as a copy marked with 'stale': True.
+    """
+    def decorator(func):
+        flight = SingleFlight()
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+            value = cache.get(k, _MISSING)
+            if value is not _MISSING:
+                return value
+            value = await flight.do(k, func, *args, **kwargs)
+            if value:
+                cache.set(k, value)
+                if stale is not None:
+                    stale.set(k, value)
+            elif stale is not None:
+                previous = stale.get(k)
+                if isinstance(previous, dict):
+                    return dict(previous, stale=True)
+            return value
+        wrapper.flight = flight
+        return wrapper
+    return decorator
@@ -0,0 +1,52 @@
+# circuit.py
+import time
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing. After failure_threshold
+    consecutive failures the circuit opens and calls are refused for
+    reset_timeout seconds. Then a single trial call is let through, and its
+    outcome closes the circuit or keeps it open for another period.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        # half open, restarting the period refuses other calls until the trial reports back
+        self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def healthy(self):
+        """True when the last call succeeded."""
+        return self.failures == 0
+
+_breakers = {}
+
+def configure(host, failure_threshold=5, reset_timeout=60):
+    _breakers[host] = CircuitBreaker(failure_threshold, reset_timeout)
+
+def get_breaker(host):
+    return _breakers.get(host)
+
+def breakers():
+    return dict(_breakers)
@@ -0,0 +1,106 @@
+# commandqueue.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+import instrumentation
+
+QUEUE_WAIT = instrumentation.histogram('command_queue_seconds', "Time commands waited for a worker")
+SHED = instrumentation.counter('commands_shed_total', "Commands turned away because their queue was full")
+
+class Lane:
+    """
+    Bounded queue and worker pool for one cost class. Guilds take turns, and
+    within a guild users take turns, so a burst from one user or one server
+    only delays itself.
+    """
+
+    def __init__(self, name, workers, max_queue, max_per_user, max_per_guild):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_per_guild = max_per_guild
+        self._guilds = OrderedDict() # guild -> OrderedDict(user -> deque of (queued at, job))
+        self._size = 0
+        self._user_load = {} # user -> queued or running commands
+        self._guild_size = {} # guild -> queued commands
+        self._ready = asyncio.Semaphore(0)
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    def submit(self, guild, user, job):
+        """Queues job, a coroutine function. Returns False if it was shed."""
+        if (self._size >= self.max_queue
+                or self._user_load.get(user, 0) >= self.max_per_user
+                or self._guild_size.get(guild, 0) >= self.max_per_guild):
+            SHED.inc(cost=self.name)
+            return False
+        self.start()
+        self._guilds.setdefault(guild, OrderedDict()).setdefault(user, deque()).append((time.monotonic(), job))
+        self._size += 1
+        self._user_load[user] = self._user_load.get(user, 0) + 1
+        self._guild_size[guild] = self._guild_size.get(guild, 0) + 1
+        self._ready.release()
+        return True
+
+    def queued(self):
+        return self._size
+
+    def _next(self):
+        guild, users = next(iter(self._guilds.items()))
+        self._guilds.move_to_end(guild)
+        user, jobs = next(iter(users.items()))
+        users.move_to_end(user)
+        queued_at, job = jobs.popleft()
+        if not jobs:
+            del users[user]
+        if not users:
+            del self._guilds[guild]
+        self._size -= 1
+        self._guild_size[guild] -= 1
+        if not self._guild_size[guild]:
+            del self._guild_size[guild]
+        return user, queued_at, job
+
+    async def _work(self):
+        while True:
+            await self._ready.acquire()
+            user, queued_at, job = self._next()
+            QUEUE_WAIT.observe(time.monotonic() - queued_at, cost=self.name)
+            try:
+                await job()
+            except Exception:
+                logging.exception(f"Command failed in {self.name} queue")
+            finally:
+                self._user_load[user] -= 1
+                if not self._user_load[user]:
+                    del self._user_load[user]
+
+class CommandQueue:
+    """
+    Runs commands through a lane per cost class, each with its own workers,
+    so cheap commands never wait behind expensive ones. classes maps a cost
+    class to (workers, max queued).
+    """
+
+    def __init__(self, classes, max_per_user=3, max_per_guild=20):
+        self.lanes = {
+            name: Lane(name, workers, max_queue, max_per_user, max_per_guild)
+            for name, (workers, max_queue) in classes.items()
+        }
+        instrumentation.register_collector(self._collect)
+
+    def submit(self, cost, guild, user, job):
+        return self.lanes[cost].submit(guild, user, job)
+
+    def queued(self):
+        return sum(lane.queued() for lane in self.lanes.values())
+
+    def _collect(self):
+        for name, lane in self.lanes.items():
+            instrumentation.gauge('command_queue_depth', "Commands waiting for a worker").set(lane.queued(), cost=name)
@@ -0,0 +1,339 @@
+# db.py
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import instrumentation
+
+DB_PATH = "watchlist.db"
+
+TABLES = ('nft_watchlist', 'coin_watchlist')
+DEFAULT_WATCH_DAYS = 30
+WRITE_DELAY = 0.5
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Each entry upgrades the schema by one version, tracked in PRAGMA user_version
+MIGRATIONS = [
+    [
+        f"CREATE TABLE IF NOT EXISTS {table} ("
+        "alert_id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, name VARCHAR, requester VARCHAR, "
+        "requester_id VARCHAR, alert_value REAL, triggered INTEGER, watch_limit INTEGER, "
+        "time_added DATETIME, active CHAR, channel_id BIGINT)"
+        for table in TABLES
+    ] + [
+        f"CREATE INDEX IF NOT EXISTS idx_{table}_active_requester ON {table} (requester_id) WHERE active='Y'"
+        for table in TABLES
+    ] + [
+        f"CREATE INDEX IF NOT EXISTS idx_{table}_active_name ON {table} (name) WHERE active='Y'"
+        for table in TABLES
+    ],
+    [
+        f"ALTER TABLE {table} ADD COLUMN expires_at DATETIME"
+        for table in TABLES
+    ] + [
+        f"UPDATE {table} SET expires_at=datetime(time_added, '+{DEFAULT_WATCH_DAYS} days')"
+        for table in TABLES
+    ] + [
+        f"CREATE INDEX IF NOT EXISTS idx_{table}_active_expires ON {table} (expires_at) WHERE active='Y'"
+        for table in TABLES
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS coin_map ("
+        "id INTEGER PRIMARY KEY NOT NULL, symbol VARCHAR, slug VARCHAR, name VARCHAR, rank INTEGER, updated_at REAL)"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS poll_state ("
+        "type VARCHAR NOT NULL, asset VARCHAR NOT NULL, due REAL, interval REAL, price REAL, observed REAL, "
+        "PRIMARY KEY (type, asset))"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS guild_settings ("
+        "guild_id BIGINT PRIMARY KEY NOT NULL, currency VARCHAR)"
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS price_history ("
+        "type VARCHAR NOT NULL, asset VARCHAR NOT NULL, tier INTEGER NOT NULL, t REAL NOT NULL, price REAL, "
+        "PRIMARY KEY (type, asset, tier, t))"
+    ],
+]
+
+_conn = None
+
+def get_connection():
+    """
+    Returns the shared connection, opening it and bringing the schema up to
+    date on first use.
+    """
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_PATH)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        migrate(_conn)
+    return _conn
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, statements in enumerate(MIGRATIONS[version:], start=version+1):
+        with conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version={i}")
+        logging.warning(f"Migrated {DB_PATH} to schema version {i}")
+
+def close():
+    global _conn
+    WRITER.close()
+    _next_ids.clear()
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+class Writer:
+    """
+    Write-behind queue for watchlist mutations. Statements are collected for
+    up to WRITE_DELAY seconds and committed together in one transaction on a
+    dedicated thread, so the event loop never waits on SQLite.
+    """
+
+    def __init__(self, delay=WRITE_DELAY):
+        self.delay = delay
+        self.commits = 0
+        self._pending = []
+        self._task = None
+        self._executor = None
+        self._conn = None
+
+    def submit(self, sql, params=(), many=False):
+        get_connection() # the schema must exist before the writer thread uses it
+        self._pending.append((sql, params, many))
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync() # no event loop, e.g. a script
+            return
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.delay)
+                await self.flush()
+        finally:
+            self._task = None
+
+    async def flush(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            await asyncio.get_event_loop().run_in_executor(self._get_executor(), self._commit, batch)
+
+    def flush_sync(self):
+        batch, self._pending = self._pending, []
+        if batch:
+            self._get_executor().submit(self._commit, batch).result()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush_sync()
+        if self._executor is not None:
+            self._executor.submit(self._close_connection).result()
+            self._executor.shutdown()
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        return self._executor
+
+    def _commit(self, batch):
+        if self._conn is None:
+            self._conn = sqlite3.connect(DB_PATH)
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        with instrumentation.timer('db_seconds', op='commit'):
+            try:
+                with self._conn:
+                    for sql, params, many in batch:
+                        (self._conn.executemany if many else self._conn.execute)(sql, params)
+            except sqlite3.Error as e:
+                # retry one statement at a time so a single bad write does not lose the batch
+                logging.warning(f"Batched write failed, retrying individually - {e}")
+                for sql, params, many in batch:
+                    try:
+                        with self._conn:
+                            (self._conn.executemany if many else self._conn.execute)(sql, params)
+                    except sqlite3.Error as e:
+                        logging.warning(f"Dropped write {sql!r} - {e}")
+        self.commits += 1
+
+    def _close_connection(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+WRITER = Writer()
+_next_ids = {}
+
+def next_alert_id(table):
+    """
+    Allocates alert ids up front so inserts can be queued. AUTOINCREMENT
+    never reuses ids, so allocation continues from the highest ever issued.
+    """
+    if table not in _next_ids:
+        conn = get_connection()
+        highest = conn.execute(f"SELECT MAX(alert_id) FROM {table}").fetchone()[0] or 0
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+        _next_ids[table] = max(highest, seq[0] if seq else 0)
+    _next_ids[table] += 1
+    return _next_ids[table]
+
+def get_table(type):
+    return 'nft_watchlist' if type.lower() == 'nft' else 'coin_watchlist'
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='add_to_watchlist')
+def add_to_watchlist(type, item, alert_value, requester, requester_id, channel_id, watch_days=DEFAULT_WATCH_DAYS):
+    """Queues the insert and returns the new row as it will be stored."""
+    table = get_table(type)
+    now = datetime.utcnow()
+    row = (
+        next_alert_id(table), item, requester, requester_id, float(alert_value), 0, None,
+        now.strftime(TIMESTAMP_FORMAT), 'Y', channel_id, (now + timedelta(days=watch_days)).strftime(TIMESTAMP_FORMAT)
+    )
+    WRITER.submit(
+        f"INSERT INTO {table} "
+        "(alert_id, name, requester, requester_id, alert_value, triggered, watch_limit, time_added, active, channel_id, expires_at)"
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        row
+    )
+    return row
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='get_active_alerts')
+def get_active_alerts(type):
+    return get_connection().execute(
+        "SELECT * "
+        f"FROM {get_table(type)} "
+        "WHERE active='Y' "
+        "AND expires_at>CURRENT_TIMESTAMP;"
+    ).fetchall()
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='expire_alerts')
+def expire_alerts(type):
+    WRITER.submit(
+        f"UPDATE {get_table(type)} "
+        "SET active='N' "
+        "WHERE active='Y' "
+        "AND expires_at<=CURRENT_TIMESTAMP;"
+    )
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='update_after_alert')
+def update_after_alert(alert_id, type):
+    WRITER.submit(
+        f"UPDATE {get_table(type)} "
+        "SET triggered=triggered+1, active='N' "
+        "WHERE alert_id=?",
+        (alert_id,)
+    )
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='clear_watchlist')
+def clear_watchlist(requester_id, type):
+    WRITER.submit(
+        f"UPDATE {get_table(type)} "
+        "SET active='N' "
+        "WHERE requester_id=? "
+        "AND active='Y';",
+        (requester_id,)
+    )
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='get_coin_map')
+def get_coin_map():
+    rows = get_connection().execute(
+        "SELECT id, symbol, slug, name, rank, updated_at "
+        "FROM coin_map;"
+    ).fetchall()
+    updated = min((row[5] for row in rows), default=0)
+    return [row[:5] for row in rows], updated
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='replace_coin_map')
+def replace_coin_map(entries, updated):
+    WRITER.submit("DELETE FROM coin_map;")
+    WRITER.submit(
+        "INSERT INTO coin_map "
+        "(id, symbol, slug, name, rank, updated_at)"
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [entry + (updated,) for entry in entries],
+        many=True
+    )
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='get_poll_state')
+def get_poll_state(type):
+    return get_connection().execute(
+        "SELECT asset, due, interval, price, observed "
+        "FROM poll_state "
+        "WHERE type=?;",
+        (type,)
+    ).fetchall()
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='save_poll_state')
+def save_poll_state(type, rows):
+    WRITER.submit(
+        "INSERT OR REPLACE INTO poll_state "
+        "(type, asset, due, interval, price, observed)"
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(type,) + tuple(row) for row in rows],
+        many=True
+    )
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='delete_poll_state')
+def delete_poll_state(type, assets):
+    WRITER.submit(
+        "DELETE FROM poll_state "
+        "WHERE type=? AND asset=?;",
+        [(type, asset) for asset in assets],
+        many=True
+    )
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='get_price_history')
+def get_price_history():
+    return get_connection().execute(
+        "SELECT type, asset, tier, t, price "
+        "FROM price_history "
+        "ORDER BY type, asset, tier, t;"
+    ).fetchall()
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='save_price_history')
+def save_price_history(rows, cutoffs):
+    """Upserts (type, asset, tier, time, price) rows and drops points older than each (tier, cutoff)."""
+    WRITER.submit(
+        "INSERT OR REPLACE INTO price_history "
+        "(type, asset, tier, t, price)"
+        "VALUES (?, ?, ?, ?, ?)",
+        rows,
+        many=True
+    )
+    WRITER.submit(
+        "DELETE FROM price_history "
+        "WHERE tier=? AND t<?;",
+        cutoffs,
+        many=True
+    )
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='get_guild_currencies')
+def get_guild_currencies():
+    return get_connection().execute(
+        "SELECT guild_id, currency "
+        "FROM guild_settings "
+        "WHERE currency IS NOT NULL;"
+    ).fetchall()
+
+@instrumentation.timed('db_seconds', "Time spent on SQLite operations", op='set_guild_currency')
+def set_guild_currency(guild_id, currency):
+    WRITER.submit(
+        "INSERT INTO guild_settings (guild_id, currency) "
+        "VALUES (?, ?) "
+        "ON CONFLICT(guild_id) DO UPDATE SET currency=excluded.currency",
+        (guild_id, currency)
+    )
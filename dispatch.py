@@ -0,0 +1,107 @@
+# dispatch.py
+import asyncio
+import logging
+
+import discord
+
+MAX_MESSAGE_LENGTH = 2000
+MAX_RETRIES = 3
+BACKOFF_BASE = 2
+
+class AlertDispatcher:
+    """
+    Delivers alert notifications in the background. Notifications queued for
+    the same channel are combined into as few messages as possible, channels
+    are sent to concurrently up to a limit, and each channel has at most one
+    send in flight so its messages stay in order.
+
+    get_channel(channel_id) is awaited to resolve a channel (None defers the
+    notifications) and on_sent(keys) is called with the keys delivered.
+    """
+
+    def __init__(self, get_channel, on_sent, concurrency=10, collect_delay=0.5):
+        self.get_channel = get_channel
+        self.on_sent = on_sent
+        self.collect_delay = collect_delay
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = set() # keys queued or being sent
+        self._waiting = {} # channel_id -> [(key, text)]
+        self._busy = set() # channel ids with a sender running
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def submit(self, key, channel_id, text):
+        """Queues text for channel_id. Returns False if key is already pending."""
+        if key in self._pending:
+            return False
+        self._pending.add(key)
+        self._queue.put_nowait((key, channel_id, text))
+        return True
+
+    def pending(self):
+        return len(self._pending)
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # give the rest of an evaluation pass a moment to land so it is grouped
+            await asyncio.sleep(self.collect_delay)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for key, channel_id, text in batch:
+                self._waiting.setdefault(channel_id, []).append((key, text))
+            for channel_id in list(self._waiting):
+                if channel_id not in self._busy:
+                    self._busy.add(channel_id)
+                    asyncio.ensure_future(self._send_channel(channel_id))
+
+    async def _send_channel(self, channel_id):
+        try:
+            while self._waiting.get(channel_id):
+                items = self._waiting.pop(channel_id)
+                async with self._semaphore:
+                    await self._deliver(channel_id, items)
+        finally:
+            self._busy.discard(channel_id)
+
+    async def _deliver(self, channel_id, items):
+        try:
+            channel = await self.get_channel(channel_id)
+            if channel is None:
+                logging.warning(f"Deferring {len(items)} alerts, channel {channel_id} is unavailable")
+                return
+            for chunk in chunk_lines(items, MAX_MESSAGE_LENGTH):
+                await send_with_retry(channel, '\n'.join(text for _, text in chunk))
+                self.on_sent([key for key, _ in chunk])
+        except Exception as e:
+            logging.warning(f"Failed to send alerts to channel {channel_id} - {e}")
+        finally:
+            for key, _ in items:
+                self._pending.discard(key)
+
+def chunk_lines(items, limit):
+    """Splits (key, text) items into groups whose joined text fits in limit."""
+    chunk, length = [], 0
+    for item in items:
+        size = len(item[1]) + (1 if chunk else 0)
+        if chunk and length + size > limit:
+            yield chunk
+            chunk, length = [], 0
+            size = len(item[1])
+        chunk.append(item)
+        length += size
+    if chunk:
+        yield chunk
+
+async def send_with_retry(channel, content):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await channel.send(content)
+        except discord.HTTPException as e:
+            if e.status != 429 or attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(BACKOFF_BASE * 2**attempt)
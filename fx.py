@@ -0,0 +1,51 @@
+# fx.py
+
+SYMBOLS = {
+    'USD': '$',
+    'GBP': '£',
+    'EUR': '€',
+    'JPY': '¥',
+    'CNY': '¥',
+    'INR': '₹',
+    'KRW': '₩',
+    'RUB': '₽',
+    'TRY': '₺',
+    'NGN': '₦',
+    'CAD': 'C$',
+    'AUD': 'A$',
+    'NZD': 'NZ$',
+    'HKD': 'HK$',
+    'SGD': 'S$',
+    'BRL': 'R$',
+    'CHF': 'CHF ',
+}
+
+class RateTable:
+    """
+    USD exchange rates for a fixed set of fiat currencies. The whole table is
+    replaced on each refresh, so converting a quote never waits on a request.
+    """
+
+    def __init__(self, currencies):
+        self.currencies = tuple(dict.fromkeys(['USD'] + [c.upper() for c in currencies]))
+        self.rates = {'USD': 1.0}
+        self.updated = 0
+
+    def load(self, rates, updated):
+        self.rates = {'USD': 1.0, **{c: r for c, r in rates.items() if isinstance(r, (int, float)) and r > 0}}
+        self.updated = updated
+
+    def supports(self, currency):
+        return currency.upper() in self.currencies
+
+    def convert(self, usd):
+        """Returns {currency: value} for every currency with a known rate."""
+        if usd is None:
+            return {}
+        return {currency: usd * rate for currency, rate in self.rates.items()}
+
+    def __len__(self):
+        return len(self.rates)
+
+def symbol(currency):
+    return SYMBOLS.get(currency, f"{currency} ")
@@ -0,0 +1,178 @@
+# history.py
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+# (resolution seconds, retention seconds) per tier, finest first. Points that
+# age out of a tier are downsampled to the next one, keeping the last price in
+# each bucket, and dropped after the coarsest tier. A raw point recorded within
+# the first tier's resolution of the previous one replaces its price, so a
+# series holds at most about 5k points however often it is recorded.
+TIERS = (
+    (30, 6 * 60 * 60),
+    (5 * 60, 7 * 24 * 60 * 60),
+    (60 * 60, 90 * 24 * 60 * 60),
+)
+COMPACT_INTERVAL = 60
+
+class Series:
+    """Append-only price series for one asset, stored as parallel arrays per tier."""
+
+    __slots__ = ('times', 'prices', '_compacted', '_saved')
+
+    def __init__(self):
+        self.times = [array('d') for _ in TIERS]
+        self.prices = [array('d') for _ in TIERS]
+        self._compacted = 0
+        self._saved = [0] * len(TIERS) # per tier, time of the last point handed out by unsaved()
+
+    def append(self, t, price):
+        times, prices = self.times[0], self.prices[0]
+        if times and t < times[-1]:
+            t = times[-1]
+        if times and t - times[-1] < TIERS[0][0]:
+            prices[-1] = price
+            return
+        times.append(t)
+        prices.append(price)
+        if t - self._compacted >= COMPACT_INTERVAL:
+            self.compact(t)
+
+    def compact(self, now):
+        for i, (_, retention) in enumerate(TIERS):
+            times, prices = self.times[i], self.prices[i]
+            n = bisect_left(times, now - retention)
+            if not n:
+                continue
+            if i + 1 < len(TIERS):
+                self._downsample(i + 1, times[:n], prices[:n])
+            del times[:n]
+            del prices[:n]
+        self._compacted = now
+
+    def _downsample(self, tier, times, prices):
+        resolution = TIERS[tier][0]
+        to_times, to_prices = self.times[tier], self.prices[tier]
+        for t, price in zip(times, prices):
+            bucket = t - t % resolution
+            if to_times and to_times[-1] >= bucket:
+                to_prices[-1] = price
+            else:
+                to_times.append(bucket)
+                to_prices.append(price)
+
+    def restore(self, tier, t, price):
+        """Appends a persisted point to tier, oldest first."""
+        self.times[tier].append(t)
+        self.prices[tier].append(price)
+        self._saved[tier] = t
+
+    def unsaved(self):
+        """
+        Returns (tier, time, price) for points added since the last call. Each
+        tier's last point is repeated, since a later append or downsample may
+        have changed its price.
+        """
+        points = []
+        for tier, (times, prices) in enumerate(zip(self.times, self.prices)):
+            i = bisect_left(times, self._saved[tier])
+            points.extend((tier, t, price) for t, price in zip(times[i:], prices[i:]))
+            if times:
+                self._saved[tier] = times[-1]
+        return points
+
+    def points(self, since=0):
+        """Returns [(time, price)] from since onwards, oldest first."""
+        points = []
+        for times, prices in zip(reversed(self.times), reversed(self.prices)):
+            i = bisect_left(times, since)
+            points.extend(zip(times[i:], prices[i:]))
+        return points
+
+    def latest(self):
+        for times, prices in zip(self.times, self.prices):
+            if times:
+                return times[-1], prices[-1]
+        return None
+
+    def price_at(self, t):
+        """Last recorded price at or before t."""
+        for times, prices in zip(self.times, self.prices):
+            i = bisect_right(times, t)
+            if i:
+                return prices[i-1]
+        return None
+
+    def __len__(self):
+        return sum(len(times) for times in self.times)
+
+class PriceHistory:
+
+    def __init__(self):
+        self._series = {}
+
+    def record(self, type, asset, price, t=None):
+        if not asset or price is None:
+            return
+        self._get_or_create(type, asset).append(time.time() if t is None else t, float(price))
+
+    def load(self, rows, now=None):
+        """Restores persisted (type, asset, tier, time, price) rows, oldest first within each tier."""
+        for type, asset, tier, t, price in rows:
+            if tier < len(TIERS):
+                self._get_or_create(type, asset).restore(tier, t, price)
+        now = time.time() if now is None else now
+        for series in self._series.values():
+            series.compact(now)
+
+    def unsaved(self):
+        """Returns (type, asset, tier, time, price) rows to persist, see Series.unsaved."""
+        return [
+            (type, asset) + point
+            for (type, asset), series in self._series.items()
+            for point in series.unsaved()
+        ]
+
+    def _get_or_create(self, type, asset):
+        series = self._series.get((type, asset))
+        if series is None:
+            series = self._series[(type, asset)] = Series()
+        return series
+
+    def get(self, type, asset):
+        return self._series.get((type, asset))
+
+    def percent_change(self, type, asset, seconds, now=None):
+        """Percent move of the latest price against the price seconds ago, or None without enough history."""
+        series = self.get(type, asset)
+        if not series:
+            return None
+        now = time.time() if now is None else now
+        _, latest = series.latest()
+        earlier = series.price_at(now - seconds)
+        if not earlier:
+            return None
+        return (latest - earlier) / earlier * 100
+
+    def summary(self, type, asset, window=7 * 24 * 60 * 60, now=None):
+        series = self.get(type, asset)
+        if not series:
+            return None
+        now = time.time() if now is None else now
+        points = series.points(now - window)
+        if not points:
+            return None
+        prices = [p for _, p in points]
+        return {
+            "latest": prices[-1],
+            "updated": points[-1][0],
+            "low": min(prices),
+            "high": max(prices),
+            "points": len(series),
+            "change_1h": self.percent_change(type, asset, 60 * 60, now),
+            "change_24h": self.percent_change(type, asset, 24 * 60 * 60, now),
+            "change_7d": self.percent_change(type, asset, 7 * 24 * 60 * 60, now)
+        }
+
+    def __len__(self):
+        return len(self._series)
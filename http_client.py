@@ -0,0 +1,176 @@
+# http_client.py
+import asyncio
+import json
+import logging
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import circuit
+import instrumentation
+import ratelimit
+from cache import SingleFlight, TTLCache
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+POOL_SIZE_PER_HOST = 20
+DNS_CACHE_TTL = 300
+MAX_RETRIES = 3
+BACKOFF_BASE = 2
+DEFAULT_TIMEOUT = 10
+
+UPSTREAM_FAILURES = instrumentation.counter('upstream_failures_total', "Upstream requests that failed or timed out")
+HEDGES = instrumentation.counter('upstream_hedges_total', "Second attempts started for slow interactive requests")
+
+class UpstreamError(Exception):
+    pass
+
+_sessions = {}
+_timeouts = {} # host -> total seconds per attempt
+_hedges = {} # host -> seconds before an interactive request is hedged
+_flight = SingleFlight()
+# request key -> (ETag, Last-Modified, decoded body) for conditional requests
+_validators = TTLCache(maxsize=4096, ttl=24 * 60 * 60)
+
+def configure(host, timeout=None, hedge_after=None):
+    if timeout:
+        _timeouts[host] = timeout
+    if hedge_after:
+        _hedges[host] = hedge_after
+
+def get_session(url):
+    """
+    Returns the pooled session for the host of url, creating it on first use.
+    Sessions are kept for the life of the process so connections are reused.
+    """
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=POOL_SIZE_PER_HOST, ttl_dns_cache=DNS_CACHE_TTL)
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[host] = session
+    return session
+
+async def get_json(url, params=None, headers=None, conditional=False):
+    """
+    GETs url and decodes the JSON body, returning None on failure. Identical
+    requests already in flight share a single upstream call. With conditional
+    the last response's validators are sent and a 304 reuses its body.
+    """
+    key = (url, tuple(sorted((params or {}).items())))
+    return await _flight.do(key, _get_json, url, params, headers, key if conditional else None)
+
+async def _get_json(url, params=None, headers=None, validator_key=None):
+    """
+    Requests to a host whose circuit is open fail fast. Interactive requests
+    to a host with a hedge delay get a second attempt if the first is slow.
+    """
+    host = urlsplit(url).netloc
+    breaker = circuit.get_breaker(host)
+    if breaker and not breaker.allow():
+        logging.debug(f"Circuit open for {host}, skipping {url}")
+        return None
+
+    hedge_after = _hedges.get(host) if ratelimit.PRIORITY.get() == ratelimit.INTERACTIVE else None
+    try:
+        if hedge_after:
+            data = await _hedged(lambda: _fetch(url, params, headers, validator_key), hedge_after, host)
+        else:
+            data = await _fetch(url, params, headers, validator_key)
+    except UpstreamError as e:
+        logging.warning(f"Request to {url} failed - {e}")
+        UPSTREAM_FAILURES.inc(host=host)
+        if breaker:
+            breaker.record_failure()
+        return None
+
+    if breaker:
+        breaker.record_success()
+    return data
+
+async def _fetch(url, params=None, headers=None, validator_key=None):
+    """
+    Requests wait on the host's rate limit bucket, and a 429 backs the bucket
+    off for the Retry-After period before retrying.
+    """
+    host = urlsplit(url).netloc
+    session = get_session(url)
+    bucket = ratelimit.get_bucket(host)
+    timeout = aiohttp.ClientTimeout(total=_timeouts.get(host, DEFAULT_TIMEOUT))
+    cached = _validators.get(validator_key) if validator_key else None
+    if cached:
+        headers = dict(headers or {})
+        if cached[0]:
+            headers['If-None-Match'] = cached[0]
+        if cached[1]:
+            headers['If-Modified-Since'] = cached[1]
+    for attempt in range(MAX_RETRIES + 1):
+        if bucket:
+            await bucket.acquire()
+        try:
+            async with session.get(url, params=params, headers=headers, timeout=timeout) as response:
+                if response.status == 429:
+                    retry_after = ratelimit.parse_retry_after(response.headers.get('Retry-After'))
+                    delay = retry_after if retry_after is not None else BACKOFF_BASE * 2**attempt
+                    logging.warning(f"Rate limited by {url}, backing off {delay}s")
+                    if bucket:
+                        bucket.backoff(delay)
+                    else:
+                        await asyncio.sleep(delay)
+                    continue
+                if response.status >= 500:
+                    raise UpstreamError(f"status {response.status}")
+                if response.status == 304 and cached:
+                    return cached[2]
+                body = await response.read()
+                etag, modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            data = loads(body)
+            if validator_key and response.status == 200 and (etag or modified):
+                _validators.set(validator_key, (etag, modified, data))
+            return data
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise UpstreamError(str(e) or type(e).__name__) from e
+    raise UpstreamError(f"gave up after {MAX_RETRIES} retries")
+
+async def _hedged(factory, delay, host):
+    """
+    Awaits factory(), starting a second attempt if the first has not finished
+    after delay seconds. Returns whichever succeeds first.
+    """
+    tasks = [asyncio.ensure_future(factory())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            HEDGES.inc(host=host)
+            tasks.append(asyncio.ensure_future(factory()))
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def healthy(url):
+    """False while requests to the host of url are failing, so a None result may not mean not found."""
+    breaker = circuit.get_breaker(urlsplit(url).netloc)
+    return breaker is None or breaker.healthy()
+
+def _collect_circuits():
+    for host, breaker in circuit.breakers().items():
+        instrumentation.gauge('circuit_open', "1 while requests to a host are refused").set(int(breaker.is_open()), host=host)
+
+instrumentation.register_collector(_collect_circuits)
+
+async def close():
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
@@ -0,0 +1,162 @@
+# instrumentation.py
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+
+PREFIX = 'cryptobot_'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = {}
+_collectors = []
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, {}, value
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {} # labels -> [per bucket counts (last is +Inf), sum]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', key, {'le': format_value(bound)}, cumulative
+            yield f'{self.name}_sum', key, {}, total
+            yield f'{self.name}_count', key, {}, cumulative
+
+def _get(cls, name, help, **kwargs):
+    name = PREFIX + name
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = _metrics[name] = cls(name, help, **kwargs)
+    return metric
+
+def counter(name, help=''):
+    return _get(Counter, name, help)
+
+def gauge(name, help=''):
+    return _get(Gauge, name, help)
+
+def histogram(name, help='', buckets=DEFAULT_BUCKETS):
+    return _get(Histogram, name, help, buckets=buckets)
+
+@contextmanager
+def timer(name, help='', **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram(name, help).observe(time.perf_counter() - start, **labels)
+
+def timed(name, help='', **labels):
+    """Records the duration of every call to the decorated function or coroutine function."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with timer(name, help, **labels):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with timer(name, help, **labels):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def register_collector(collector):
+    """collector is called before every scrape to refresh derived gauges."""
+    _collectors.append(collector)
+
+def register_cache(name, cache):
+    def collect():
+        stats = cache.stats()
+        gauge('cache_hits', "Cache hits since start").set(stats['hits'], cache=name)
+        gauge('cache_misses', "Cache misses since start").set(stats['misses'], cache=name)
+        gauge('cache_hit_ratio', "Cache hits / lookups").set(stats['hit_rate'], cache=name)
+        gauge('cache_entries', "Entries currently cached").set(stats['size'], cache=name)
+    register_collector(collect)
+
+def render():
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e:
+            logging.warning(f"Metrics collector failed - {e}")
+    lines = []
+    for metric in _metrics.values():
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, key, extra, value in metric.samples():
+            lines.append(f'{name}{format_labels(key, **extra)} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+async def monitor_loop_lag(interval=0.5):
+    lag = histogram('event_loop_lag_seconds', "Delay in waking a sleeping task on the event loop")
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(loop.time() - start - interval, 0))
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+async def start_server(host, port):
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.warning(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
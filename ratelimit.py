@@ -0,0 +1,96 @@
+# ratelimit.py
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Lane used for upstream requests made from the current task. Background loops
+# set this once so their requests queue behind user commands.
+PRIORITY = ContextVar('priority', default=INTERACTIVE)
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate tokens per second up to capacity. Waiters
+    are served in priority order, then first come first served.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._waiters = [] # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._dispatcher = None
+
+    async def acquire(self, priority=None):
+        priority = PRIORITY.get() if priority is None else priority
+        self._refill()
+        if not self._waiters and self._tokens >= 1 and time.monotonic() >= self._blocked_until:
+            self._tokens -= 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    def backoff(self, seconds):
+        """Stops handing out tokens for seconds, e.g. after a 429."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def queued(self):
+        return len(self._waiters)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def _dispatch(self):
+        try:
+            while self._waiters:
+                wait = self._blocked_until - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                self._refill()
+                if self._tokens < 1:
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+                    continue
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    continue
+                self._tokens -= 1
+                future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+_buckets = {}
+
+def configure(host, per_minute, burst=None):
+    _buckets[host] = TokenBucket(per_minute / 60, burst or max(per_minute // 10, 1))
+
+def get_bucket(host):
+    return _buckets.get(host)
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,60 @@
+# resolver.py
+
+class SymbolIndex:
+    """
+    In-memory view of the CoinMarketCap id map, used to resolve a search term
+    to coin ids without a network call. Entries are (id, symbol, slug, name, rank).
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_symbol = {}
+        self.by_slug = {}
+        self.updated = 0
+
+    @staticmethod
+    def fields(entry):
+        """Returns the (id, symbol, slug, rank) of an entry."""
+        return entry[0], entry[1], entry[2], entry[4]
+
+    def load(self, entries, updated):
+        self.by_id.clear()
+        self.by_symbol.clear()
+        self.by_slug.clear()
+        for entry in entries:
+            id, symbol, slug, _ = self.fields(entry)
+            self.by_id[id] = entry
+            self.by_symbol.setdefault(symbol.upper(), []).append(entry)
+            self.by_slug[slug.lower()] = entry
+        for matches in self.by_symbol.values():
+            # several coins can share a symbol, prefer the best ranked one
+            matches.sort(key=lambda e: (self.fields(e)[3] is None, self.fields(e)[3]))
+        self.updated = updated
+
+    def resolve(self, term):
+        """Returns the (symbol match, slug match) entries for term, either may be None."""
+        symbol_matches = self.by_symbol.get(term.upper())
+        return symbol_matches[0] if symbol_matches else None, self.by_slug.get(term.lower())
+
+    def __len__(self):
+        return len(self.by_id)
+
+class ListingsSnapshot(SymbolIndex):
+    """
+    Latest CoinMarketCap listings for the top coins by market cap, so popular
+    coins are quoted without a request each. Entries are the raw listing
+    dicts, which have the same shape as quotes.
+    """
+
+    @staticmethod
+    def fields(entry):
+        return entry['id'], entry['symbol'], entry['slug'], entry.get('cmc_rank')
+
+    def fresh(self, now, max_age):
+        return bool(self.by_id) and now - self.updated <= max_age
+
+    def price(self, symbol):
+        entry, _ = self.resolve(symbol)
+        if entry is None:
+            return None
+        return (entry.get('quote') or {}).get('USD', {}).get('price')
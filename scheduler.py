@@ -0,0 +1,123 @@
+# scheduler.py
+import heapq
+import random
+from bisect import bisect_left
+
+class PollScheduler:
+    """
+    Decides when each watched asset is next polled. Assets close to their
+    nearest alert threshold, or moving quickly, are polled sooner. When the
+    combined poll rate would exceed budget (polls per minute) every interval
+    is stretched to fit.
+    """
+
+    def __init__(self, min_interval, max_interval, budget, default_volatility=0.05 / 3600, safety=0.25, smoothing=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.default_volatility = default_volatility
+        self.safety = safety
+        self.smoothing = smoothing
+        self._heap = [] # (due, asset)
+        self._due = {} # asset -> due time
+        self._intervals = {} # asset -> last computed interval
+        self._demand = 0 # polls per minute implied by _intervals
+        self._last = {} # asset -> (price, time)
+        self._volatility = {} # asset -> smoothed relative move per second
+
+    def sync(self, assets, now):
+        """
+        Schedules new assets immediately and forgets ones no longer watched.
+        Returns the forgotten assets.
+        """
+        assets = set(assets)
+        for asset in assets - self._due.keys():
+            self._set_interval(asset, self.min_interval)
+            self._push(asset, now)
+        forgotten = list(self._due.keys() - assets)
+        for asset in forgotten:
+            self.forget(asset)
+        return forgotten
+
+    def forget(self, asset):
+        self._due.pop(asset, None)
+        self._set_interval(asset, None)
+        self._last.pop(asset, None)
+        self._volatility.pop(asset, None)
+
+    def restore(self, asset, due, interval, price, observed, now):
+        """
+        Resumes a persisted schedule. Overdue assets are spread across their
+        interval rather than all being polled at once.
+        """
+        interval = min(max(interval or self.max_interval, self.min_interval), self.max_interval)
+        if due is None or due < now:
+            due = now + random.uniform(0, interval)
+        self._set_interval(asset, interval)
+        if price and observed:
+            self._last[asset] = (price, observed)
+        self._push(asset, due)
+
+    def state(self, asset):
+        """Returns (due, interval, last price, last observed) for persisting."""
+        price, observed = self._last.get(asset, (None, None))
+        return self._due.get(asset), self._intervals.get(asset), price, observed
+
+    def due(self, now):
+        """Returns the assets whose poll time has passed. Each should be passed back to observe."""
+        assets = []
+        while self._heap and self._heap[0][0] <= now:
+            when, asset = heapq.heappop(self._heap)
+            if self._due.get(asset) == when:
+                assets.append(asset)
+        return assets
+
+    def observe(self, asset, price, thresholds, now):
+        """Records a polled price (None if the poll failed) and reschedules asset."""
+        if price:
+            last = self._last.get(asset)
+            if last and last[0] and now > last[1]:
+                speed = abs(price - last[0]) / last[0] / (now - last[1])
+                previous = self._volatility.get(asset, speed)
+                self._volatility[asset] = self.smoothing * speed + (1 - self.smoothing) * previous
+            self._last[asset] = (price, now)
+
+        self._set_interval(asset, self.next_interval(asset, price, thresholds))
+        self._push(asset, now + self._intervals[asset] * self.budget_factor())
+
+    def next_interval(self, asset, price, thresholds):
+        if not thresholds:
+            return self.max_interval
+        if not price:
+            # a failed poll says nothing about the distance, keep the last interval
+            return self._intervals.get(asset, self.min_interval)
+        distance = nearest_distance(price, thresholds) / price
+        volatility = max(self._volatility.get(asset, self.default_volatility), 1e-12)
+        interval = self.safety * distance / volatility
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def budget_factor(self):
+        if not self.budget:
+            return 1
+        return max(1, self._demand / self.budget)
+
+    def _set_interval(self, asset, interval):
+        previous = self._intervals.pop(asset, None)
+        if previous:
+            self._demand -= 60 / previous
+        if interval:
+            self._intervals[asset] = interval
+            self._demand += 60 / interval
+
+    def _push(self, asset, when):
+        self._due[asset] = when
+        heapq.heappush(self._heap, (when, asset))
+
+    def __len__(self):
+        return len(self._due)
+
+def nearest_distance(price, thresholds):
+    """Absolute distance from price to the closest value in sorted thresholds."""
+    i = bisect_left(thresholds, price)
+    candidates = thresholds[max(i-1, 0):i+1]
+    return min(abs(price - t) for t in candidates)
@@ -0,0 +1,112 @@
+# stream.py
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+import http_client
+
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 300
+TICK_TYPES = ('coin', 'nft')
+
+def parse_ticks(message):
+    """
+    Returns (type, asset, price) tuples from a feed message. A message is a
+    JSON object {"type": "coin"|"nft", "asset": ..., "price": ...} or a list
+    of them. A missing type means coin, and ticks of any other type are dropped.
+    """
+    try:
+        data = json.loads(message) if isinstance(message, (str, bytes)) else message
+    except ValueError:
+        logging.debug(f"Ignoring malformed feed message {message!r}")
+        return []
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        return []
+
+    ticks = []
+    for tick in data:
+        try:
+            type, asset, price = tick.get('type', 'coin'), tick['asset'], float(tick['price'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            logging.debug(f"Ignoring malformed tick {tick!r}")
+            continue
+        if type not in TICK_TYPES or not isinstance(asset, str) or not asset:
+            logging.debug(f"Ignoring tick with unsupported type or asset {tick!r}")
+            continue
+        ticks.append((type, asset, price))
+    return ticks
+
+async def websocket_source(url):
+    session = http_client.get_session(url)
+    async with session.ws_connect(url, heartbeat=30) as ws:
+        async for msg in ws:
+            if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                yield msg.data
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                raise ws.exception()
+
+async def ndjson_source(url):
+    session = http_client.get_session(url)
+    async with session.get(url, timeout=aiohttp.ClientTimeout(total=None, sock_read=120)) as response:
+        async for line in response.content:
+            if line.strip():
+                yield line
+
+class LocalFeed:
+    """In-process stand-in for a price feed, for tests and local runs."""
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+
+    def publish(self, type, asset, price):
+        self.send({"type": type, "asset": asset, "price": price})
+
+    def send(self, message):
+        """Queues a raw feed message, which may be malformed."""
+        self._queue.put_nowait(message)
+
+    def fail(self, error):
+        """Makes the current connection raise error, as a dropped socket would."""
+        self._queue.put_nowait(error)
+
+    def close(self):
+        self._queue.put_nowait(None)
+
+    async def source(self):
+        while True:
+            message = await self._queue.get()
+            if message is None:
+                return
+            if isinstance(message, BaseException):
+                raise message
+            yield message
+
+def get_source(url):
+    if url.startswith(('ws://', 'wss://')):
+        return lambda: websocket_source(url)
+    return lambda: ndjson_source(url)
+
+async def run_feed(source, on_tick):
+    """
+    Consumes source (a callable returning an async iterator of messages) and
+    awaits on_tick(type, asset, price) for every tick, reconnecting with
+    backoff when the feed drops.
+    """
+    delay = RECONNECT_DELAY
+    while True:
+        try:
+            async for message in source():
+                delay = RECONNECT_DELAY
+                for tick in parse_ticks(message):
+                    await on_tick(*tick)
+            logging.warning("Price feed closed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Price feed failed - {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
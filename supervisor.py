@@ -0,0 +1,46 @@
+# supervisor.py
+import asyncio
+import logging
+import time
+
+MIN_BACKOFF = 1
+MAX_BACKOFF = 300
+# a task that ran this long before failing is considered healthy again
+HEALTHY_RUNTIME = 600
+
+_tasks = {}
+
+async def supervise(name, factory):
+    """
+    Runs the coroutine returned by factory(), restarting it with exponential
+    backoff whenever it raises or returns.
+    """
+    backoff = MIN_BACKOFF
+    while True:
+        started = time.monotonic()
+        try:
+            await factory()
+            logging.warning(f"{time.ctime()}: Background task {name} exited, restarting")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception(f"{time.ctime()}: Background task {name} crashed, restarting in {backoff}s")
+        if time.monotonic() - started > HEALTHY_RUNTIME:
+            backoff = MIN_BACKOFF
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+def start(name, factory):
+    """Starts a supervised task unless one with this name is already running."""
+    task = _tasks.get(name)
+    if task is not None and not task.done():
+        return task
+    task = _tasks[name] = asyncio.ensure_future(supervise(name, factory))
+    return task
+
+async def stop():
+    tasks = list(_tasks.values())
+    _tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Points db at an empty SQLite file for the test and closes it afterwards."""
+    db.close()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'watchlist.db'))
+    yield db
+    db.close()
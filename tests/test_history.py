@@ -0,0 +1,53 @@
+import asyncio
+
+import bot
+import db
+from alertbook import AlertBook
+from history import TIERS, PriceHistory, Series
+
+def test_raw_tier_keeps_one_point_per_resolution():
+    series = Series()
+    for i in range(3600):
+        series.append(1000 + i, float(i))
+
+    assert len(series.times[0]) == 3600 // TIERS[0][0]
+    assert series.latest() == (1000 + 3600 - TIERS[0][0], 3599.0)
+
+def test_history_survives_a_restart(database):
+    history = PriceHistory()
+    now = 10 * 24 * 60 * 60
+    for t in range(now - 8 * 24 * 60 * 60, now, 60):
+        history.record('coin', 'ETH', t / 1000, t=t)
+    history.get('coin', 'ETH').compact(now)
+
+    db.save_price_history(history.unsaved(), [(tier, now - retention) for tier, (_, retention) in enumerate(TIERS)])
+    db.close()
+
+    restored = PriceHistory()
+    restored.load(db.get_price_history(), now)
+    assert restored.summary('coin', 'ETH', now=now) == history.summary('coin', 'ETH', now=now)
+    # nothing older than the coarse tiers' retention is kept in the database
+    assert all(t >= now - TIERS[tier][1] for _, _, tier, t, _ in db.get_price_history())
+
+def test_unsaved_only_returns_new_points():
+    history = PriceHistory()
+    history.record('nft', 'apes', 1.0, t=0)
+    assert history.unsaved() == [('nft', 'apes', 0, 0, 1.0)]
+
+    history.record('nft', 'apes', 2.0, t=10)
+    # within the raw resolution, the last point's price is updated and saved again
+    assert history.unsaved() == [('nft', 'apes', 0, 0, 2.0)]
+    history.record('nft', 'apes', 3.0, t=100)
+    assert history.unsaved() == [('nft', 'apes', 0, 0, 2.0), ('nft', 'apes', 0, 100, 3.0)]
+
+def test_feed_ticks_for_unwatched_assets_are_not_recorded(monkeypatch):
+    history = PriceHistory()
+    monkeypatch.setattr(bot, 'HISTORY', history)
+    monkeypatch.setattr(bot, 'COIN_ALERTS', AlertBook(key=str.upper))
+
+    asyncio.run(bot.on_price_tick('coin', 'doge', 0.1))
+    assert history.get('coin', 'DOGE') is None
+
+    history.record('coin', 'DOGE', 0.09, t=0)
+    asyncio.run(bot.on_price_tick('coin', 'doge', 0.1))
+    assert history.get('coin', 'DOGE').latest()[1] == 0.1
@@ -0,0 +1,30 @@
+import bot
+import db
+from alertbook import AlertBook
+from scheduler import PollScheduler
+
+def make_schedule():
+    return PollScheduler(min_interval=60, max_interval=3600, budget=0)
+
+def test_restore_prunes_rows_for_assets_without_alerts(database, monkeypatch):
+    coin_alerts = AlertBook(key=str.upper)
+    monkeypatch.setattr(bot, 'COIN_ALERTS', coin_alerts)
+    monkeypatch.setattr(bot, 'NFT_ALERTS', AlertBook())
+    monkeypatch.setattr(bot, 'COIN_SCHEDULE', make_schedule())
+    monkeypatch.setattr(bot, 'NFT_SCHEDULE', make_schedule())
+
+    coin_alerts.add(db.add_to_watchlist('coin', 'btc', 40000, 'user', '1', 10))
+    db.save_poll_state('coin', [('BTC', 0, 60, None, None), ('ETH', 0, 60, None, None)])
+
+    bot.restore_poll_state()
+
+    assert [row[0] for row in db.get_poll_state('coin')] == ['BTC']
+    assert len(bot.COIN_SCHEDULE) == 1
+
+def test_sync_returns_forgotten_assets():
+    schedule = make_schedule()
+    schedule.sync(['BTC', 'ETH'], now=0)
+
+    assert schedule.sync(['BTC'], now=10) == ['ETH']
+    assert schedule.sync(['BTC'], now=20) == []
+    assert len(schedule) == 1
@@ -0,0 +1,109 @@
+import asyncio
+
+import bot
+import db
+import stream
+from alertbook import AlertBook
+from dispatch import AlertDispatcher
+
+def run_until(feed_task_factory, done, timeout=5):
+    """Runs the feed until done() is true, then cancels it."""
+    async def run():
+        task = asyncio.ensure_future(feed_task_factory())
+        try:
+            while not done():
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+    asyncio.run(asyncio.wait_for(run(), timeout))
+
+def test_parse_ticks_skips_malformed_and_unsupported_ticks():
+    message = (
+        '[{"asset": "eth", "price": 1},'
+        ' {"type": "nft", "asset": "apes", "price": "2.5"},'
+        ' {"type": "fx", "asset": "GBP", "price": 1},'
+        ' {"type": 5, "asset": "BTC", "price": 1},'
+        ' {"asset": "BTC"},'
+        ' {"asset": "BTC", "price": "high"},'
+        ' "BTC"]'
+    )
+    assert stream.parse_ticks(message) == [('coin', 'eth', 1.0), ('nft', 'apes', 2.5)]
+    assert stream.parse_ticks('not json') == []
+    assert stream.parse_ticks('42') == []
+
+def test_run_feed_ignores_malformed_messages():
+    feed = stream.LocalFeed()
+    ticks = []
+
+    async def on_tick(*tick):
+        ticks.append(tick)
+
+    feed.send('{"asset": ')
+    feed.send('{"type": "fx", "asset": "GBP", "price": 1}')
+    feed.publish('coin', 'BTC', 50000)
+
+    run_until(lambda: stream.run_feed(feed.source, on_tick), lambda: ticks)
+    assert ticks == [('coin', 'BTC', 50000.0)]
+
+def test_run_feed_reconnects_after_source_error(monkeypatch):
+    monkeypatch.setattr(stream, 'RECONNECT_DELAY', 0.01)
+    feed = stream.LocalFeed()
+    ticks = []
+    connections = []
+
+    def source():
+        connections.append(True)
+        return feed.source()
+
+    async def on_tick(*tick):
+        ticks.append(tick)
+
+    feed.publish('coin', 'BTC', 1)
+    feed.fail(ConnectionError('dropped'))
+    feed.publish('nft', 'apes', 2)
+
+    run_until(lambda: stream.run_feed(source, on_tick), lambda: len(ticks) == 2)
+    assert ticks == [('coin', 'BTC', 1.0), ('nft', 'apes', 2.0)]
+    assert len(connections) == 2
+
+def test_alert_triggered_by_tick_and_poll_is_sent_once(database, monkeypatch):
+    sent = []
+
+    class Channel:
+        async def send(self, content):
+            sent.append(content)
+
+    async def get_channel(channel_id):
+        return Channel()
+
+    async def get_coin_prices(symbols):
+        return {'ETH': 2900.0}
+
+    book = AlertBook(key=str.upper)
+    monkeypatch.setattr(bot, 'COIN_ALERTS', book)
+    monkeypatch.setattr(bot, 'get_coin_prices', get_coin_prices)
+    feed = stream.LocalFeed()
+
+    async def run():
+        dispatcher = AlertDispatcher(get_channel, bot.on_alerts_sent, collect_delay=0.05)
+        monkeypatch.setattr(bot, 'DISPATCHER', dispatcher)
+        dispatcher.start()
+        book.add(db.add_to_watchlist('coin', 'eth', 3000, 'user', '1', 10))
+
+        task = asyncio.ensure_future(stream.run_feed(feed.source, bot.on_price_tick))
+        feed.publish('coin', 'eth', 2900)
+        while not dispatcher.pending():
+            await asyncio.sleep(0.01)
+        # the poll lands while the tick's notification is still queued
+        await bot.coin_alert(book, ['ETH'])
+        while dispatcher.pending():
+            await asyncio.sleep(0.01)
+        # once sent the alert is retired, so a later poll does not repeat it
+        await bot.coin_alert(book, ['ETH'])
+        await asyncio.sleep(0.1)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert len(sent) == 1
+    assert sent[0].count('Heads up') == 1
+    assert len(book) == 0